@@ -1,9 +1,6 @@
-import logging
-import os
-from logging.handlers import SMTPHandler, RotatingFileHandler
-
 from elasticsearch import Elasticsearch
 from flask import Flask, request, current_app
+from flask_babel import Babel
 from flask_bootstrap import Bootstrap
 from flask_login import LoginManager
 from flask_mail import Mail
@@ -20,6 +17,7 @@ login.login_view = 'auth.login'
 mail = Mail()
 bootstrap = Bootstrap()
 moment = Moment()
+babel = Babel()
 
 
 # application factory pattern
@@ -27,14 +25,36 @@ def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
 
+    from app.database import configure_engine, engine_options
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
     db.init_app(app)
+    with app.app_context():
+        configure_engine(db.engine, app.config)
     migrate.init_app(app, db)
     login.init_app(app)
     mail.init_app(app)
     bootstrap.init_app(app)
     moment.init_app(app)
+    babel.init_app(app)
 
     app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) if app.config['ELASTICSEARCH_URL'] else None
+    from app.search import SearchIndexer, create_search_backend
+    app.search_backend = create_search_backend(app)
+    app.search_indexer = SearchIndexer(app)
+
+    from app.cache import MemoryCache, create_cache
+    app.cache = create_cache(app)
+    app.user_cache = MemoryCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TIMEOUT'])
+    from app.passwords import PasswordHasher
+    app.password_hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_SALT_LENGTH'],
+                                         app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_QUEUE_SIZE'],
+                                         app.config['PASSWORD_HASH_TIMEOUT'])
+    from app.email import MailPool
+    app.mail_pool = MailPool(app, mail)
+    from app.last_seen import LastSeenBuffer
+    app.last_seen = LastSeenBuffer(app.config['LAST_SEEN_FLUSH_INTERVAL'], app.config['LAST_SEEN_TOLERANCE'], app)
+    from app.notifications import NotificationHub
+    app.notification_hub = NotificationHub(max_listeners=app.config['NOTIFICATION_MAX_LISTENERS'])
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -45,34 +65,23 @@ def create_app(config_class=Config):
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
+    from app.api import bp as api_bp
+    app.register_blueprint(api_bp, url_prefix='/api/v1')
+
+    from app.cli import bp as cli_bp
+    app.register_blueprint(cli_bp)
+
     if app.debug is False and app.testing is False:
-        if app.config['MAIL_SERVER']:
-            auth = None
-            if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
-                auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
-            secure = None
-            if app.config['MAIL_USE_TLS']:
-                secure = ()
-            mail_handler = SMTPHandler(
-                mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
-                fromaddr='no-reply@' + app.config['MAIL_SERVER'],
-                toaddrs=app.config['ADMINS'], subject='MathApp Failure',
-                credentials=auth, secure=secure)
-            mail_handler.setLevel(logging.ERROR)
-            app.logger.addHandler(mail_handler)
-
-        if os.path.exists('logs') is False:
-            os.mkdir('logs')
-        file_handler = RotatingFileHandler('logs/math_app.log', maxBytes=10240, backupCount=10)
-        file_handler.setFormatter(
-            logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-        file_handler.setLevel(logging.INFO)
-        app.logger.addHandler(file_handler)
-
-        app.logger.setLevel(logging.INFO)
+        from app.log import configure_logging
+        configure_logging(app)
         app.logger.info('MathApp')
 
     return app
 
 
+@babel.localeselector
+def get_locale():
+    return request.accept_languages.best_match(current_app.config['LANGUAGES'])
+
+
 from app import models
@@ -0,0 +1,36 @@
+from functools import wraps
+
+from flask import g, request
+
+from app.api.errors import error_response
+from app.models import User
+
+
+def basic_auth_required(f):
+    # username and password, only used to hand out tokens
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        auth = request.authorization
+        user = User.query.filter_by(username=auth.username).first() if auth else None
+        if user is None or user.check_password(auth.password) is False:
+            response = error_response(401)
+            response.headers['WWW-Authenticate'] = 'Basic realm="MathApp API"'
+            return response
+        g.current_user = user
+        return f(*args, **kwargs)
+    return decorated
+
+
+def token_auth_required(f):
+    # "Authorization: Bearer <token>", no session cookie or CSRF token is involved
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        user = User.check_token(token.strip()) if scheme.lower() == 'bearer' and token.strip() else None
+        if user is None:
+            response = error_response(401)
+            response.headers['WWW-Authenticate'] = 'Bearer realm="MathApp API"'
+            return response
+        g.current_user = user
+        return f(*args, **kwargs)
+    return decorated
@@ -0,0 +1,99 @@
+from flask import current_app, g, jsonify, request, url_for
+
+from app import db
+from app.api import bp
+from app.api.auth import token_auth_required
+from app.api.errors import bad_request, error_response
+from app.models import User, Equation
+from app.pagination import keyset_paginate
+
+# responses are built from these columns alone, no Equation or User objects are loaded
+EQUATION_COLUMNS = (Equation.id, Equation.x_var, Equation.y_var, Equation.operator, Equation.expression,
+                    Equation.equation_result, Equation.equation_str, Equation.timestamp,
+                    User.username.label('author'))
+
+
+def equation_rows(query):
+    return query.join(User, User.id == Equation.user_id).with_entities(*EQUATION_COLUMNS)
+
+
+def to_dict(row):
+    data = dict(row._mapping)
+    data['timestamp'] = row.timestamp.isoformat() + 'Z'
+    data['_links'] = {'self': url_for('api.get_equation', id=row.id)}
+    return data
+
+
+def conditional(payload):
+    # an unchanged page costs the client a 304 without a body
+    response = jsonify(payload)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def page(sources, endpoint, **values):
+    per_page = min(request.args.get('limit', current_app.config['EQUATIONS_PER_PAGE'], type=int),
+                   current_app.config['API_MAX_PER_PAGE'])
+    equations = keyset_paginate(sources, max(per_page, 1), after=request.args.get('after'),
+                                before=request.args.get('before'))
+    return conditional({
+        'items': [to_dict(row) for row in equations.items],
+        '_links': {
+            'next': url_for(endpoint, after=equations.next_cursor, **values) if equations.has_next else None,
+            'prev': url_for(endpoint, before=equations.prev_cursor, **values) if equations.has_prev else None,
+        },
+    })
+
+
+@bp.route('/equations', methods=['GET'])
+@token_auth_required
+def get_equations():
+    return page([(equation_rows(Equation.query), (Equation.timestamp, Equation.id))], 'api.get_equations')
+
+
+@bp.route('/equations/<int:id>', methods=['GET'])
+@token_auth_required
+def get_equation(id):
+    row = equation_rows(Equation.query.filter(Equation.id == id)).first()
+    if row is None:
+        return error_response(404)
+    return conditional(to_dict(row))
+
+
+@bp.route('/users/<username>/equations', methods=['GET'])
+@token_auth_required
+def get_user_equations(username):
+    user_id = db.session.query(User.id).filter_by(username=username).scalar()
+    if user_id is None:
+        return error_response(404)
+    query = equation_rows(Equation.query.filter(Equation.user_id == user_id))
+    return page([(query, (Equation.timestamp, Equation.id))], 'api.get_user_equations', username=username)
+
+
+@bp.route('/feed', methods=['GET'])
+@token_auth_required
+def get_feed():
+    sources = [(equation_rows(query), columns or (Equation.timestamp, Equation.id))
+               for query, columns in g.current_user.followed_equation_sources()]
+    return page(sources, 'api.get_feed')
+
+
+@bp.route('/equations', methods=['POST'])
+@token_auth_required
+def create_equations():
+    # {"equations": [[x, operator or expression, y], ...]}, inserted with a single executemany INSERT
+    triples = (request.get_json(silent=True) or {}).get('equations')
+    if isinstance(triples, list) is False:
+        return bad_request('Expected a JSON object with an "equations" list.')
+    if len(triples) > current_app.config['EQUATIONS_PER_BATCH']:
+        return error_response(413, f'At most {current_app.config["EQUATIONS_PER_BATCH"]} equations per request.')
+    rows, errors = Equation.evaluate_batch(triples)
+    created = Equation.insert_batch(g.current_user, rows)
+    db.session.commit()
+    return jsonify({
+        'created': created,
+        'results': [{'error': errors[i]} if row is None else
+                    {'equation_result': row['equation_result'], 'equation_str': row['equation_str']}
+                    for i, row in enumerate(rows)]
+    }), 201
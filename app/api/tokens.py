@@ -0,0 +1,22 @@
+from flask import current_app, g, jsonify
+
+from app import db
+from app.api import bp
+from app.api.auth import basic_auth_required, token_auth_required
+
+
+@bp.route('/tokens', methods=['POST'])
+@basic_auth_required
+def get_token():
+    token = g.current_user.get_token(current_app.config['API_TOKEN_EXPIRES_IN'])
+    expires = g.current_user.token_expiration
+    db.session.commit()
+    return jsonify({'token': token, 'expires': expires.isoformat() + 'Z'}), 201
+
+
+@bp.route('/tokens', methods=['DELETE'])
+@token_auth_required
+def revoke_token():
+    g.current_user.revoke_token()
+    db.session.commit()
+    return '', 204
@@ -19,6 +19,8 @@ def login():
         if user is None or user.check_password(form.password.data) is False:
             flash('Invalid username or password')
             return redirect(url_for('auth.login'))
+        # saves the hash if check_password upgraded it
+        db.session.commit()
         login_user(user, remember=form.remember_me.data)
         next_page = request.args.get('next')
         if next_page is None or url_parse(next_page).netloc != '':
@@ -0,0 +1,201 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from flask import current_app
+
+from app import db
+
+
+class MemoryCache(object):
+    # least recently used entries are evicted once there are more than `threshold`. entries are local to the
+    # process, use FileSystemCache when several workers must see the same invalidations
+    def __init__(self, threshold=1000, default_timeout=300):
+        self.threshold = threshold
+        self.default_timeout = default_timeout
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        timeout = self.default_timeout if timeout is None else timeout
+        with self.lock:
+            self.entries[key] = (time.time() + timeout if timeout else None, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.threshold:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class FileSystemCache(object):
+    # one pickle file per key in `path`, so every worker on the host shares the entries and the invalidations.
+    # files are replaced atomically, and the oldest are pruned once there are more than `threshold`
+    def __init__(self, path, threshold=1000, default_timeout=300):
+        self.path = path
+        self.threshold = threshold
+        self.default_timeout = default_timeout
+        os.makedirs(path, exist_ok=True)
+
+    def filename(self, key):
+        return os.path.join(self.path, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self.filename(key), 'rb') as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires is not None and expires <= time.time():
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, timeout=None):
+        timeout = self.default_timeout if timeout is None else timeout
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((time.time() + timeout if timeout else None, value), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.filename(key))
+        except OSError:
+            current_app.logger.warning('Could not write cache entry %s', key)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        self.prune()
+
+    def delete(self, key):
+        try:
+            os.remove(self.filename(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+    def prune(self):
+        names = [name for name in os.listdir(self.path) if name.endswith('.tmp') is False]
+        if len(names) <= self.threshold:
+            return
+        paths = sorted((os.path.join(self.path, name) for name in names), key=_mtime)
+        for path in paths[:len(paths) - self.threshold]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0
+
+
+class NullCache(object):
+    def get(self, key):
+        return None
+
+    def set(self, key, value, timeout=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class Cache(object):
+    # entries are stored with the version of every tag they depend on, and invalidating a tag gives it a new
+    # version, so one write drops every page that showed the changed data without having to know their keys
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get(self, key):
+        entry = self.backend.get(key)
+        if entry is None:
+            return None
+        versions, value = entry
+        for tag, version in versions.items():
+            if self.backend.get('tag:' + tag) != version:
+                return None
+        return value
+
+    def versions(self, tags):
+        return {tag: self.version(tag) for tag in tags}
+
+    def set(self, key, value, versions=None, timeout=None):
+        # versions is a snapshot from versions(), taken before the data behind value was read. a tag invalidated
+        # in between then no longer matches, and the entry is never served
+        self.backend.set(key, (dict(versions or {}), value), timeout=timeout)
+
+    def version(self, tag):
+        version = self.backend.get('tag:' + tag)
+        if version is None:
+            version = uuid.uuid4().hex
+            self.backend.set('tag:' + tag, version, timeout=0)
+        return version
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            self.backend.set('tag:' + tag, uuid.uuid4().hex, timeout=0)
+
+    def clear(self):
+        self.backend.clear()
+
+
+def create_cache(app):
+    # CACHE_TYPE is 'memory', 'filesystem' or 'none'
+    cache_type = (app.config['CACHE_TYPE'] or 'memory').lower()
+    if cache_type == 'memory':
+        return Cache(MemoryCache(app.config['CACHE_THRESHOLD'], app.config['CACHE_DEFAULT_TIMEOUT']))
+    if cache_type == 'filesystem':
+        return Cache(FileSystemCache(app.config['CACHE_DIR'], app.config['CACHE_THRESHOLD'],
+                                     app.config['CACHE_DEFAULT_TIMEOUT']))
+    if cache_type == 'none':
+        return Cache(NullCache())
+    raise ValueError(f'Unknown CACHE_TYPE {cache_type!r}')
+
+
+def invalidate_on_commit(*tags):
+    # tags are only invalidated once the transaction has committed, so a concurrent request cannot cache the old
+    # data again in between
+    db.session.info.setdefault('cache_tags', set()).update(tags)
+
+
+def invalidate_after_commit(session):
+    tags = session.info.pop('cache_tags', None)
+    if tags:
+        current_app.cache.invalidate(*tags)
+
+
+def discard_after_soft_rollback(session, previous_transaction):
+    session.info.pop('cache_tags', None)
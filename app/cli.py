@@ -0,0 +1,106 @@
+import gzip
+import time
+
+import click
+from flask import Blueprint, current_app
+from werkzeug.security import generate_password_hash
+
+from app import db
+from app.models import User, Equation
+
+bp = Blueprint('cli', __name__, cli_group=None)
+
+
+@bp.cli.command('reconcile-counters')
+def reconcile_counters():
+    """Rebuild the follower, following and equation counters of every user."""
+    count = User.reconcile_counters()
+    db.session.commit()
+    click.echo(f'Reconciled counters for {count} users.')
+
+
+@bp.cli.command('reindex')
+@click.option('--chunk-size', default=1000, show_default=True, help='Rows read and sent per bulk request.')
+def reindex(chunk_size):
+    """Rebuild the equation search index from the database."""
+    count = Equation.reindex(chunk_size)
+    click.echo(f'Indexed {count} equations.')
+
+
+@bp.cli.command('export-equations')
+@click.argument('username')
+@click.option('--format', 'export_format', type=click.Choice(['csv', 'ndjson']), default='csv', show_default=True)
+@click.option('--feed', is_flag=True, help='Export the home timeline of USERNAME instead.')
+@click.option('--gzip', 'compress', is_flag=True, help='Compress the output with gzip.')
+@click.option('--output', type=click.File('wb'), default='-', help='File to write, defaults to stdout.')
+@click.option('--chunk-size', default=1000, show_default=True, help='Rows read and written at a time.')
+def export_equations(username, export_format, feed, compress, output, chunk_size):
+    """Stream the equations of a user as CSV or NDJSON."""
+    from app import export
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f'User {username} not found.')
+    for chunk in export.export_equations(user, export_format, feed, compress, chunk_size):
+        output.write(chunk)
+
+
+@bp.cli.command('import-equations')
+@click.argument('source', type=click.File('rb'))
+@click.option('--format', 'input_format', type=click.Choice(['csv', 'ndjson']), default=None,
+              help='Input format, guessed from the file name by default.')
+@click.option('--chunk-size', default=1000, show_default=True, help='Rows evaluated and inserted per transaction.')
+@click.option('--no-reindex', is_flag=True, help='Skip indexing the imported equations for search.')
+def import_equations(source, input_format, chunk_size, no_reindex):
+    """Import equations from CSV or NDJSON with username, x_var, operator or expression and y_var columns."""
+    from app import importer
+    compressed = source.name.endswith('.gz')
+    name = source.name[:-3] if compressed else source.name
+    input_format = input_format or ('ndjson' if name.endswith(('.ndjson', '.jsonl')) else 'csv')
+    stream = gzip.GzipFile(fileobj=source) if compressed else source
+
+    def progress(read, imported, errors):
+        for line, error in errors.items():
+            click.echo(f'row {line}: {error}', err=True)
+        click.echo(f'{read} rows read, {imported} imported', err=True)
+
+    imported, rejected, unindexed = importer.import_equations(importer.read_records(stream, input_format),
+                                                              chunk_size, not no_reindex, progress)
+    if unindexed:
+        click.echo(f'{unindexed} rows not indexed for search, run \'flask reindex\'', err=True)
+    click.echo(f'Imported {imported} equations, rejected {rejected} rows.')
+
+
+@bp.cli.command('hash-benchmark')
+@click.option('--method', default=None, help='werkzeug hash method to time, defaults to PASSWORD_HASH_METHOD.')
+@click.option('--rounds', default=10, show_default=True, help='Hashes to time.')
+def hash_benchmark(method, rounds):
+    """Time password hashing to choose an iteration count."""
+    method = method or current_app.config['PASSWORD_HASH_METHOD']
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        generate_password_hash('benchmark', method=method, salt_length=current_app.config['PASSWORD_SALT_LENGTH'])
+        timings.append(time.perf_counter() - started)
+    workers = current_app.config['PASSWORD_HASH_WORKERS']
+    mean = sum(timings) / len(timings)
+    click.echo(f'{method}: mean {mean * 1000:.1f} ms, max {max(timings) * 1000:.1f} ms per hash, '
+               f'about {workers / mean:.0f} logins per second with {workers} hashing threads.')
+
+
+@bp.cli.command('explain')
+def explain():
+    """Show the query plan of every hot query and fail on full table scans."""
+    from app.query_plans import check_query_plans
+    try:
+        plans = check_query_plans()
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    full_scans = 0
+    for name, plan in plans.items():
+        click.echo(name)
+        for detail, full_scan in plan:
+            click.echo(f'    {detail}{"  <-- full scan" if full_scan else ""}')
+            full_scans += full_scan
+    if full_scans:
+        raise click.ClickException(f'{full_scans} full table scans.')
+    click.echo('No full table scans.')
@@ -0,0 +1,59 @@
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+# config key -> pragma, applied to every new SQLite connection unless the value is None
+SQLITE_PRAGMAS = [
+    ('SQLITE_JOURNAL_MODE', 'journal_mode'),
+    ('SQLITE_SYNCHRONOUS', 'synchronous'),
+    ('SQLITE_CACHE_SIZE', 'cache_size'),
+    ('SQLITE_MMAP_SIZE', 'mmap_size'),
+    ('SQLITE_BUSY_TIMEOUT', 'busy_timeout'),
+]
+
+
+def engine_options(config):
+    # SQLALCHEMY_ENGINE_OPTIONS with the pool settings of the DATABASE_POOL_* keys filled in. options set in
+    # SQLALCHEMY_ENGINE_OPTIONS itself win
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    options = dict(config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    if url.get_backend_name() == 'sqlite':
+        if url.database in (None, '', ':memory:'):
+            # flask-sqlalchemy keeps in-memory databases on a single shared connection
+            return options
+        if config['DATABASE_POOL_SIZE']:
+            # pooled connections keep their page cache and memory map between requests, sqlite's own default
+            # for files is to open a new connection every time
+            options.setdefault('poolclass', QueuePool)
+            options.setdefault('connect_args', {}).setdefault('check_same_thread', False)
+        else:
+            return options
+    else:
+        options.setdefault('pool_recycle', config['DATABASE_POOL_RECYCLE'])
+        options.setdefault('pool_pre_ping', config['DATABASE_POOL_PRE_PING'])
+    options.setdefault('pool_size', config['DATABASE_POOL_SIZE'])
+    options.setdefault('max_overflow', config['DATABASE_MAX_OVERFLOW'])
+    options.setdefault('pool_timeout', config['DATABASE_POOL_TIMEOUT'])
+    return options
+
+
+def sqlite_pragmas(config):
+    return [(pragma, config[key]) for key, pragma in SQLITE_PRAGMAS if config.get(key) is not None]
+
+
+def configure_engine(engine, config):
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = sqlite_pragmas(config)
+    if len(pragmas) == 0:
+        return
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma, value in pragmas:
+                cursor.execute(f'PRAGMA {pragma} = {value}')
+        finally:
+            cursor.close()
+
+    event.listen(engine, 'connect', set_pragmas)
@@ -1,18 +1,138 @@
-from threading import Thread
+import queue
+import smtplib
+import threading
+import time
+from collections import Counter
 
 from flask import current_app
 from flask_mail import Message
 
-from app import mail
 
+class MailPool(object):
+    # delivers queued messages from MAIL_WORKERS threads. each worker keeps its SMTP connection open for as long as
+    # messages keep arriving and only closes it after MAIL_IDLE_TIMEOUT seconds without any
+    def __init__(self, app, mail):
+        self.app = app
+        self.mail = mail
+        self.workers = app.config['MAIL_WORKERS']
+        self.batch_size = app.config['MAIL_BATCH_SIZE']
+        self.idle_timeout = app.config['MAIL_IDLE_TIMEOUT']
+        self.enqueue_timeout = app.config['MAIL_ENQUEUE_TIMEOUT']
+        self.max_retries = app.config['MAIL_MAX_RETRIES']
+        self.retry_delay = app.config['MAIL_RETRY_DELAY']
+        self.queue = queue.Queue(maxsize=app.config['MAIL_QUEUE_SIZE'])
+        self.lock = threading.Lock()
+        self.threads = []
+        self.metrics = Counter()
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+    def submit(self, msg):
+        # waits up to MAIL_ENQUEUE_TIMEOUT seconds for room in the queue, so a burst slows its senders down
+        # instead of growing without bound
+        self.start()
+        try:
+            self.queue.put(msg, timeout=self.enqueue_timeout)
+        except queue.Full:
+            self.count('dropped')
+            self.app.logger.error('Mail queue is full, dropping %r to %s', msg.subject, ', '.join(msg.recipients))
+            return False
+        self.count('queued')
+        return True
+
+    def start(self):
+        with self.lock:
+            self.threads = [thread for thread in self.threads if thread.is_alive()]
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.run, name=f'mail-worker-{len(self.threads)}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def flush(self):
+        # blocks until everything submitted so far has been sent or given up on
+        self.queue.join()
+
+    def count(self, metric, n=1):
+        with self.lock:
+            self.metrics[metric] += n
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.metrics)
+            stats['workers'] = sum(1 for thread in self.threads if thread.is_alive())
+        stats['queue_depth'] = self.queue.qsize()
+        return stats
+
+    def run(self):
+        with self.app.app_context():
+            connection = None
+            while True:
+                try:
+                    batch = [self.queue.get(timeout=self.idle_timeout if connection is not None else None)]
+                except queue.Empty:
+                    connection = self.disconnect(connection)
+                    continue
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                try:
+                    connection = self.send(connection, batch)
+                finally:
+                    for _ in batch:
+                        self.queue.task_done()
+
+    def send(self, connection, batch):
+        # sends the batch over connection, reconnecting and retrying each message with exponential backoff after
+        # transient failures. returns the connection to use for the next batch
+        for msg in batch:
+            delivered = False
+            for attempt in range(self.max_retries + 1):
+                if attempt > 0:
+                    self.count('retried')
+                    time.sleep(min(2 ** (attempt - 1) * self.retry_delay, 30))
+                try:
+                    if connection is None:
+                        connection = self.mail.connect().__enter__()
+                        self.count('connections')
+                    connection.send(msg)
+                except (smtplib.SMTPException, OSError) as e:
+                    connection = self.disconnect(connection)
+                    if self.permanent(e):
+                        self.app.logger.error('Mail %r to %s was refused: %s', msg.subject,
+                                              ', '.join(msg.recipients), e)
+                        break
+                    self.app.logger.warning('Mail %r failed (attempt %d): %s', msg.subject, attempt + 1, e)
+                except Exception:
+                    self.app.logger.exception('Mail %r could not be sent', msg.subject)
+                    break
+                else:
+                    delivered = True
+                    break
+            else:
+                self.app.logger.error('Mail %r to %s still failing after %d retries', msg.subject,
+                                      ', '.join(msg.recipients), self.max_retries)
+            self.count('sent' if delivered else 'failed')
+        return connection
+
+    @staticmethod
+    def permanent(e):
+        # 5xx replies and refused recipients will fail the same way however often they are retried
+        if isinstance(e, smtplib.SMTPRecipientsRefused):
+            return True
+        return isinstance(e, smtplib.SMTPResponseException) and e.smtp_code >= 500
+
+    @staticmethod
+    def disconnect(connection):
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except (smtplib.SMTPException, OSError):
+                pass
+        return None
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email, args=(current_app._get_current_object(), msg)).start()
+    return current_app.mail_pool.submit(msg)
@@ -1,14 +1,35 @@
-from flask import render_template
+from flask import render_template, request
 from app import db
+from app.api.errors import error_response as api_error_response
 from app.errors import bp
+from app.passwords import PasswordHasherBusy
+
+
+def wants_json_response():
+    return request.accept_mimetypes['application/json'] >= \
+        request.accept_mimetypes['text/html']
 
 
 @bp.app_errorhandler(404)
 def not_found_error(error):
+    if wants_json_response():
+        return api_error_response(404)
     return render_template('errors/404.html'), 404
 
 
 @bp.app_errorhandler(500)
 def internal_error(error):
     db.session.rollback()
-    return render_template('errors/500.html'), 500
\ No newline at end of file
+    if wants_json_response():
+        return api_error_response(500)
+    return render_template('errors/500.html'), 500
+
+
+@bp.app_errorhandler(PasswordHasherBusy)
+def password_hasher_busy_error(error):
+    db.session.rollback()
+    if wants_json_response():
+        response = api_error_response(503)
+        response.headers['Retry-After'] = '5'
+        return response
+    return render_template('errors/503.html'), 503, {'Retry-After': '5'}
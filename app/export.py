@@ -0,0 +1,74 @@
+import csv
+import io
+import json
+import zlib
+
+from app import db
+from app.models import User, Equation
+
+FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+EXPORT_COLUMNS = (Equation.id, Equation.timestamp, User.username.label('author'), Equation.x_var,
+                  Equation.operator, Equation.expression, Equation.y_var, Equation.equation_result,
+                  Equation.equation_str)
+
+
+def export_query(user, feed=False):
+    # the user's own equations, or their home timeline, newest first as plain column rows
+    if feed:
+        queries = [query.join(User, User.id == Equation.user_id).with_entities(*EXPORT_COLUMNS)
+                   for query, columns in user.followed_equation_sources()]
+        query = queries[0].union(*queries[1:]) if len(queries) > 1 else queries[0]
+    else:
+        query = db.session.query(*EXPORT_COLUMNS).join(User, User.id == Equation.user_id).filter(
+            Equation.user_id == user.id)
+    return query.order_by(Equation.timestamp.desc(), Equation.id.desc())
+
+
+def export_rows(query, chunk_size=1000):
+    # rows are fetched chunk_size at a time, from a server side cursor where the driver has one
+    for row in query.yield_per(chunk_size):
+        data = dict(row._mapping)
+        data['timestamp'] = row.timestamp.isoformat() + 'Z'
+        yield data
+
+
+def csv_chunks(rows, chunk_size=1000):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, [column.key for column in EXPORT_COLUMNS], lineterminator='\n')
+    writer.writeheader()
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def ndjson_chunks(rows, chunk_size=1000):
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(row) + '\n')
+        if len(lines) == chunk_size:
+            yield ''.join(lines)
+            lines = []
+    yield ''.join(lines)
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_equations(user, export_format='csv', feed=False, compress=False, chunk_size=1000):
+    # a generator of encoded chunks, memory use is bounded by chunk_size however many rows are exported
+    chunks = {'csv': csv_chunks, 'ndjson': ndjson_chunks}[export_format](
+        export_rows(export_query(user, feed), chunk_size), chunk_size)
+    if compress:
+        return gzip_chunks(chunks)
+    return (chunk.encode('utf-8') for chunk in chunks)
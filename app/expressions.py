@@ -0,0 +1,127 @@
+import ast
+import math
+from functools import lru_cache
+
+import numpy as np
+
+# the operators offered by EquationForm, each one is shorthand for the expression 'x <operator> y'
+BINARY_OPERATORS = ['+', '-', '*', '/']
+MAX_EXPRESSION_LENGTH = 140
+DIVIDE_BY_ZERO_MESSAGE = 'Cannot divide by zero! Please enter a different divisor!'
+EXPRESSION_CACHE_SIZE = 1024
+
+VARIABLES = ('x', 'y')
+CONSTANTS = {'pi': math.pi, 'e': math.e}
+# name -> (scalar implementation, vectorized implementation)
+FUNCTIONS = {
+    'abs': (abs, np.abs),
+    'sqrt': (math.sqrt, np.sqrt),
+    'log': (math.log, np.log),
+    'log10': (math.log10, np.log10),
+    'exp': (math.exp, np.exp),
+    'sin': (math.sin, np.sin),
+    'cos': (math.cos, np.cos),
+    'tan': (math.tan, np.tan),
+}
+SCALAR_NAMESPACE = dict(CONSTANTS, **{name: funcs[0] for name, funcs in FUNCTIONS.items()})
+ARRAY_NAMESPACE = dict(CONSTANTS, **{name: funcs[1] for name, funcs in FUNCTIONS.items()})
+
+# anything outside of this whitelist is rejected before the expression is compiled
+ALLOWED_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load, ast.Constant,
+                 ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.UAdd, ast.USub)
+
+
+class ExpressionError(ValueError):
+    pass
+
+
+class CompiledExpression(object):
+    def __init__(self, normalized, code, variables):
+        self.normalized = normalized
+        self.code = code
+        self.variables = variables
+
+    def __repr__(self):
+        return f'<CompiledExpression {self.normalized}>'
+
+    def evaluate(self, x=None, y=None):
+        namespace = dict(SCALAR_NAMESPACE,
+                         x=None if x is None else float(x),
+                         y=None if y is None else float(y))
+        try:
+            result = float(eval(self.code, {'__builtins__': {}}, namespace))
+        except ZeroDivisionError:
+            raise ExpressionError(DIVIDE_BY_ZERO_MESSAGE)
+        except (ArithmeticError, ValueError, TypeError):
+            raise ExpressionError(f'{self.normalized} is undefined for x = {x}, y = {y}.')
+        if math.isfinite(result) is False:
+            raise ExpressionError(f'{self.normalized} is undefined for x = {x}, y = {y}.')
+        return result
+
+    def evaluate_array(self, x, y):
+        # elements the expression is undefined for come back as nan/inf instead of raising
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        with np.errstate(all='ignore'):
+            result = eval(self.code, {'__builtins__': {}}, dict(ARRAY_NAMESPACE, x=x, y=y))
+        return np.broadcast_to(np.asarray(result, dtype=float), np.broadcast(x, y).shape)
+
+
+class _Validator(ast.NodeTransformer):
+    def __init__(self):
+        self.variables = set()
+
+    def generic_visit(self, node):
+        if isinstance(node, ALLOWED_NODES) is False:
+            raise ExpressionError(f'Unsupported syntax in expression: {type(node).__name__}.')
+        return super(_Validator, self).generic_visit(node)
+
+    def visit_Constant(self, node):
+        if type(node.value) not in (int, float):
+            raise ExpressionError(f'Unsupported constant in expression: {node.value!r}.')
+        # integers are promoted to floats so x ** 10 ** 10 overflows instead of building a huge int
+        return ast.copy_location(ast.Constant(float(node.value)), node)
+
+    def visit_Name(self, node):
+        if node.id in VARIABLES:
+            self.variables.add(node.id)
+        elif node.id not in CONSTANTS:
+            raise ExpressionError(f'Unknown name in expression: {node.id}.')
+        return node
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Name) is False or node.func.id not in FUNCTIONS:
+            raise ExpressionError('Only the functions {} may be called.'.format(', '.join(sorted(FUNCTIONS))))
+        if node.keywords or len(node.args) != 1:
+            raise ExpressionError(f'{node.func.id}() takes exactly one argument.')
+        node.args = [self.visit(arg) for arg in node.args]
+        return node
+
+
+def normalize_expression(source):
+    return ' '.join(str(source).split())
+
+
+def binary_expression(operator):
+    if operator not in BINARY_OPERATORS:
+        raise ExpressionError(f'Unknown operator {operator!r}.')
+    return f'x {operator} y'
+
+
+def compile_expression(source):
+    return _compile(normalize_expression(source))
+
+
+@lru_cache(maxsize=EXPRESSION_CACHE_SIZE)
+def _compile(source):
+    if len(source) == 0:
+        raise ExpressionError('Expression is empty.')
+    if len(source) > MAX_EXPRESSION_LENGTH:
+        raise ExpressionError(f'Expressions are limited to {MAX_EXPRESSION_LENGTH} characters.')
+    try:
+        tree = ast.parse(source, mode='eval')
+    except SyntaxError:
+        raise ExpressionError(f'Invalid expression: {source}')
+    validator = _Validator()
+    tree = ast.fix_missing_locations(validator.visit(tree))
+    return CompiledExpression(source, compile(tree, '<expression>', 'eval'), frozenset(validator.variables))
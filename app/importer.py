@@ -0,0 +1,126 @@
+import csv
+import io
+import json
+from datetime import datetime
+from itertools import islice
+
+from flask import current_app
+
+from app import db
+from app.models import User, Equation
+
+
+def read_records(stream, input_format):
+    # dicts from a binary stream of CSV with a header row or of NDJSON, one at a time. the columns written by
+    # 'flask export-equations' are understood, so an export can be imported again
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='' if input_format == 'csv' else None)
+    if input_format == 'csv':
+        yield from csv.DictReader(text)
+    else:
+        for line in text:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
+
+
+def parse_timestamp(value, default):
+    if value in (None, ''):
+        return default
+    return datetime.fromisoformat(value[:-1] if value.endswith('Z') else value)
+
+
+def import_chunk(records, user_ids):
+    # inserts one chunk with a single INSERT and returns (inserted, condition matching them, {index: error}).
+    # user_ids is username -> id, filled in with one query for the names this chunk adds
+    names = {(record.get('username') or record.get('author')) for record in records if isinstance(record, dict)}
+    missing = [name for name in names if name and name not in user_ids]
+    if missing:
+        user_ids.update(db.session.query(User.username, User.id).filter(User.username.in_(missing)))
+
+    errors, triples = {}, []
+    for i, record in enumerate(records):
+        if isinstance(record, dict) is False:
+            errors[i] = 'Not a JSON object.'
+            triples.append(None)
+            continue
+        triples.append([record.get('x_var'), record.get('operator') or record.get('expression'), record.get('y_var')])
+    rows, evaluate_errors = Equation.evaluate_batch(triples)
+    errors.update((i, error) for i, error in evaluate_errors.items() if i not in errors)
+
+    now = datetime.utcnow()
+    counts = {}
+    for i, row in enumerate(rows):
+        if row is None:
+            continue
+        name = records[i].get('username') or records[i].get('author')
+        if name not in user_ids:
+            errors[i], rows[i] = f'Unknown user {name!r}.', None
+            continue
+        try:
+            row.update(user_id=user_ids[name], timestamp=parse_timestamp(records[i].get('timestamp'), now))
+        except (TypeError, ValueError):
+            errors[i], rows[i] = 'Timestamps must be in ISO 8601 format.', None
+            continue
+        counts[row['user_id']] = counts.get(row['user_id'], 0) + 1
+
+    rows = [row for row in rows if row is not None]
+    inserted = None
+    if rows:
+        conditions, inserted = insert_rows(rows)
+        connection = db.session.connection()
+        for author_id, count in counts.items():
+            Equation.after_insert(connection, author_id, count, conditions[author_id])
+    db.session.commit()
+    return len(rows), inserted, errors
+
+
+def insert_rows(rows):
+    # inserts rows with one statement and returns ({author id: condition}, condition), matching exactly the rows
+    # of each author inserted here and all of them
+    connection = db.session.connection()
+    table = Equation.__table__
+    if connection.dialect.full_returning:
+        ids = {}
+        for id, user_id in connection.execute(table.insert().values(rows).returning(table.c.id, table.c.user_id)):
+            ids.setdefault(user_id, []).append(id)
+        return ({author_id: Equation.id.in_(author_ids) for author_id, author_ids in ids.items()},
+                Equation.id.in_([id for author_ids in ids.values() for id in author_ids]))
+    # without RETURNING the ids are read back. the INSERT took SQLite's write lock, which is held until the commit,
+    # so no other writer adds rows in between and this chunk's ids are the consecutive highest ones
+    connection.execute(table.insert(), rows)
+    last = connection.execute(db.select(db.func.max(table.c.id))).scalar()
+    inserted = Equation.id.between(last - len(rows) + 1, last)
+    return {author_id: db.and_(Equation.user_id == author_id, inserted)
+            for author_id in {row['user_id'] for row in rows}}, inserted
+
+
+def import_equations(records, chunk_size=1000, reindex=True, progress=None):
+    # imports an iterable of records chunk_size at a time, each chunk in its own transaction and indexed for
+    # search once committed. progress is called with (rows read, rows imported, {line: error}) after every chunk.
+    # returns (imported, rejected, unindexed)
+    user_ids = {}
+    read = imported = rejected = unindexed = 0
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if len(chunk) == 0:
+            break
+        inserted, condition, errors = import_chunk(chunk, user_ids)
+        imported, rejected = imported + inserted, rejected + len(errors)
+        if reindex and condition is not None:
+            # per-row indexing is skipped, each committed chunk is sent to the search index in bulk instead. a
+            # search outage must not stop the load, once a chunk fails the rest are left for 'flask reindex'
+            if unindexed == 0:
+                try:
+                    Equation.reindex(inserted, condition)
+                except RuntimeError as e:
+                    current_app.logger.error('Search indexing of imported equations failed: %s', e)
+                    unindexed = inserted
+            else:
+                unindexed += inserted
+        if progress is not None:
+            progress(read + len(chunk), imported, {read + i + 1: error for i, error in sorted(errors.items())})
+        read += len(chunk)
+    return imported, rejected, unindexed
@@ -0,0 +1,77 @@
+import atexit
+import threading
+from datetime import datetime, timedelta
+from time import monotonic, sleep
+
+from app import db
+from app.models import User
+
+
+class LastSeenBuffer(object):
+    # coalesces last_seen updates per user in memory and writes them out with one bulk UPDATE per flush interval.
+    # given an app, a background thread flushes every interval even while no requests arrive, and what is still
+    # pending at exit is written before the process ends
+    def __init__(self, flush_interval=60, tolerance=60, app=None):
+        self.flush_interval = flush_interval
+        self.tolerance = timedelta(seconds=tolerance)
+        self.app = app
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.last_flush = monotonic()
+        self.thread = None
+
+    def touch(self, user_id, last_seen=None, now=None):
+        now = now or datetime.utcnow()
+        with self.lock:
+            last_seen = self.pending.get(user_id, last_seen)
+            # values within the staleness tolerance are not worth a write
+            if last_seen is not None and now - last_seen < self.tolerance:
+                return False
+            self.pending[user_id] = now
+        self.start()
+        return True
+
+    def start(self):
+        with self.lock:
+            if self.app is None or (self.thread is not None and self.thread.is_alive()):
+                return
+            if self.thread is None:
+                atexit.register(self.flush_in_context)
+            self.thread = threading.Thread(target=self.run, name='last-seen-flusher', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            sleep(self.flush_interval)
+            if self.flush_due():
+                self.flush_in_context()
+
+    def flush_in_context(self):
+        with self.lock:
+            if len(self.pending) == 0:
+                return
+        with self.app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Writing buffered last_seen values failed')
+            finally:
+                db.session.remove()
+
+    def flush_due(self):
+        with self.lock:
+            return len(self.pending) > 0 and monotonic() - self.last_flush >= self.flush_interval
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = monotonic()
+        if pending:
+            table = User.__table__
+            db.session.execute(
+                table.update().where(table.c.id == db.bindparam('user_id')).values(
+                    last_seen=db.bindparam('seen')),
+                [{'user_id': user_id, 'seen': seen} for user_id, seen in pending.items()])
+            User.uncache(*pending)
+            db.session.commit()
+        return len(pending)
@@ -0,0 +1,148 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, SMTPHandler
+
+
+class JSONFormatter(logging.Formatter):
+    # one JSON object per line, for log shippers
+    def format(self, record):
+        entry = {
+            'timestamp': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'pathname': record.pathname,
+            'lineno': record.lineno,
+            'thread': record.threadName,
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class ErrorMailFilter(logging.Filter):
+    # lets at most `limit` error emails through per `interval` seconds, and drops repeats of an error seen within
+    # the last `dedup_window` seconds. the next email that does go out reports how many were suppressed in
+    # record.suppressed_mails, the record itself is shared with the other handlers and is left alone
+    def __init__(self, limit=10, interval=3600, dedup_window=600, clock=time.monotonic):
+        super(ErrorMailFilter, self).__init__()
+        self.limit = limit
+        self.interval = interval
+        self.dedup_window = dedup_window
+        self.clock = clock
+        self.sent = []
+        self.last_seen = {}
+        self.suppressed = 0
+
+    @staticmethod
+    def key(record):
+        # the same failure logged from the same place, whatever request it happened in. the last line of a
+        # formatted traceback is the exception itself
+        lines = (record.exc_text or record.getMessage()).strip().splitlines() or ['']
+        return record.name, record.pathname, record.lineno, lines[-1]
+
+    def filter(self, record):
+        now = self.clock()
+        key = self.key(record)
+        self.last_seen = {k: t for k, t in self.last_seen.items() if now - t < self.dedup_window}
+        self.sent = [t for t in self.sent if now - t < self.interval]
+        if key in self.last_seen or len(self.sent) >= self.limit:
+            self.last_seen.setdefault(key, now)
+            self.suppressed += 1
+            return False
+        self.last_seen[key] = now
+        self.sent.append(now)
+        record.suppressed_mails, self.suppressed = self.suppressed, 0
+        return True
+
+
+class ErrorMailHandler(SMTPHandler):
+    def getSubject(self, record):
+        suppressed = getattr(record, 'suppressed_mails', 0)
+        if suppressed:
+            return f'{self.subject} (+{suppressed} suppressed)'
+        return self.subject
+
+
+class StructuredQueueHandler(QueueHandler):
+    # QueueHandler.prepare() formats the traceback into the message, this keeps it apart in exc_text so the
+    # file and mail formatters still append it and JSONFormatter can report it as its own field
+    listener = None
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure_logging(app):
+    # the request thread only puts records on a queue, a QueueListener thread does the file, mail and JSON output
+    handlers = []
+    if app.config['MAIL_SERVER']:
+        auth = None
+        if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
+            auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+        secure = None
+        if app.config['MAIL_USE_TLS']:
+            secure = ()
+        mail_handler = ErrorMailHandler(
+            mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
+            fromaddr='no-reply@' + app.config['MAIL_SERVER'],
+            toaddrs=app.config['ADMINS'], subject='MathApp Failure',
+            credentials=auth, secure=secure)
+        mail_handler.setLevel(logging.ERROR)
+        mail_handler.addFilter(ErrorMailFilter(app.config['LOG_MAIL_LIMIT'], app.config['LOG_MAIL_INTERVAL'],
+                                               app.config['LOG_MAIL_DEDUP_WINDOW']))
+        handlers.append(mail_handler)
+
+    if app.config['LOG_FILE']:
+        log_dir = os.path.dirname(app.config['LOG_FILE'])
+        if log_dir and os.path.exists(log_dir) is False:
+            os.makedirs(log_dir)
+        file_handler = RotatingFileHandler(app.config['LOG_FILE'], maxBytes=app.config['LOG_MAX_BYTES'],
+                                           backupCount=app.config['LOG_BACKUP_COUNT'])
+        file_handler.setFormatter(logging.Formatter(app.config['LOG_FORMAT']))
+        handlers.append(file_handler)
+
+    if app.config['LOG_JSON']:
+        if app.config['LOG_JSON'] == '-':
+            json_handler = logging.StreamHandler(sys.stderr)
+        else:
+            json_handler = RotatingFileHandler(app.config['LOG_JSON'], maxBytes=app.config['LOG_MAX_BYTES'],
+                                               backupCount=app.config['LOG_BACKUP_COUNT'])
+        json_handler.setFormatter(JSONFormatter())
+        handlers.append(json_handler)
+
+    # app.logger is shared by every app created in this process, so replace the pipeline of an earlier one
+    stop_logging(app)
+    log_queue = queue.Queue(-1)
+    app.log_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    app.log_handler = StructuredQueueHandler(log_queue)
+    app.log_handler.listener = app.log_listener
+    app.logger.addHandler(app.log_handler)
+    app.logger.setLevel(app.config['LOG_LEVEL'])
+    app.log_listener.start()
+    atexit.register(app.log_listener.stop)
+    return app.log_listener
+
+
+def stop_logging(app):
+    # drains the queue and detaches every queue handler from app.logger
+    for handler in list(app.logger.handlers):
+        if isinstance(handler, QueueHandler):
+            app.logger.removeHandler(handler)
+            if getattr(handler, 'listener', None) is not None:
+                handler.listener.stop()
+                atexit.unregister(handler.listener.stop)
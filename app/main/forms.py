@@ -1,7 +1,9 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, DecimalField, SelectField, TextAreaField
-from wtforms.validators import DataRequired, ValidationError, NumberRange, InputRequired, Length
+from wtforms.validators import DataRequired, ValidationError, NumberRange, InputRequired, Length, Optional
 
+from app.expressions import BINARY_OPERATORS, DIVIDE_BY_ZERO_MESSAGE, MAX_EXPRESSION_LENGTH, ExpressionError, \
+    compile_expression
 from app.models import User
 
 
@@ -33,12 +35,20 @@ class EmptyForm(FlaskForm):
 
 
 class EquationForm(FlaskForm):
-    operator_choices = ['+', '-', '*', '/']
+    operator_choices = BINARY_OPERATORS
     x_var = DecimalField('X Value', validators=[InputRequired(), NumberRange()])
     y_var = DecimalField('Y Value', validators=[InputRequired(), NumberRange()])
     operator = SelectField('Operator', choices=operator_choices, validators=[DataRequired()])
+    expression = StringField('Expression (optional, may use x and y)',
+                             validators=[Optional(), Length(max=MAX_EXPRESSION_LENGTH)])
     submit = SubmitField('Submit')
 
     def validate_y_var(self, y_var):
-        if self.operator.data == '/' and y_var.data == 0:
-            raise ValidationError('Cannot divide by zero! Please enter a different divisor!')
+        if not self.expression.data and self.operator.data == '/' and y_var.data == 0:
+            raise ValidationError(DIVIDE_BY_ZERO_MESSAGE)
+
+    def validate_expression(self, expression):
+        try:
+            compile_expression(expression.data).evaluate(self.x_var.data, self.y_var.data)
+        except ExpressionError as e:
+            raise ValidationError(str(e))
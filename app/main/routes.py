@@ -1,19 +1,67 @@
+import queue
 from datetime import datetime
 
-from flask import render_template, flash, redirect, url_for, request, current_app, jsonify
+from flask import render_template, flash, redirect, url_for, request, current_app, jsonify, Response, \
+    stream_with_context, abort
 from flask_login import current_user, login_required
+from markupsafe import Markup
+from sqlalchemy.orm import joinedload
 
-from app import db
+from app import db, get_locale
+from app.export import FORMATS, export_equations
 from app.main.forms import EditProfileForm, EmptyForm, EquationForm, MessageForm
 from app.main import bp
 from app.models import User, Equation, Message, Notification
+from app.notifications import format_event
+from app.pagination import keyset_paginate, decode_cursor
 
 
 @bp.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        current_app.last_seen.touch(current_user.id, current_user.last_seen)
+        if current_app.last_seen.flush_due():
+            current_app.last_seen.flush()
+
+
+@bp.app_template_global()
+def equation_rows(equations):
+    # a rendered row only changes with its author's name and avatar, the relative timestamp is filled in by the
+    # browser. rows are cached by equation id and the version of the author's profile tag, which is looked up once
+    # per author, so a page of cached rows neither renders _equation.html nor loads equation.author
+    versions, keys = {}, []
+    for equation in equations:
+        if equation.user_id not in versions:
+            versions[equation.user_id] = current_app.cache.version(f'profile:{equation.user_id}')
+        keys.append(f'equation:{equation.id}:{versions[equation.user_id]}')
+    rows = [current_app.cache.get(key) for key in keys]
+    avatars = User.avatar_urls([equation.author for equation, row in zip(equations, rows) if row is None], 70)
+    for i, equation in enumerate(equations):
+        if rows[i] is None:
+            rows[i] = render_template('_equation.html', equation=equation, avatar=avatars[equation.user_id])
+            current_app.cache.set(keys[i], rows[i])
+    return [Markup(row) for row in rows]
+
+
+def render_feed(query, tags, endpoint, **values):
+    # the equation list and pager of explore and profile pages look the same to every viewer, so they are cached
+    # per page and locale. the first page changes whenever tags are invalidated, pages further back never gain
+    # equations and only depend on the profiles of their authors
+    after, before = request.args.get('after'), request.args.get('before')
+    key = 'feed:{}:{}:{}:{}:{}'.format(endpoint, get_locale(), ','.join(f'{k}={v}' for k, v in sorted(values.items())),
+                                       after or '', before or '')
+    feed = current_app.cache.get(key)
+    if feed is None:
+        first_page = before is not None or decode_cursor(after) is None
+        versions = current_app.cache.versions(tags if first_page else ())
+        equations = keyset_paginate(query, current_app.config['EQUATIONS_PER_PAGE'], after=after, before=before)
+        # the authors are only known once the page is read, their versions are taken before anything is rendered
+        versions.update(current_app.cache.versions({f'profile:{equation.user_id}' for equation in equations.items}))
+        next_url = url_for(endpoint, after=equations.next_cursor, **values) if equations.has_next else None
+        prev_url = url_for(endpoint, before=equations.prev_cursor, **values) if equations.has_prev else None
+        feed = render_template('_equations.html', equations=equations.items, next_url=next_url, prev_url=prev_url)
+        current_app.cache.set(key, feed, versions)
+    return Markup(feed)
 
 
 @bp.route('/', methods=['GET', 'POST'])
@@ -22,33 +70,52 @@ def before_request():
 def index():
     form = EquationForm()
     if form.validate_on_submit():
-        equation = Equation(x_var=form.x_var.data, y_var=form.y_var.data, operator=form.operator.data,
-                            author=current_user)
+        equation = Equation(x_var=form.x_var.data, y_var=form.y_var.data, author=current_user,
+                            operator=None if form.expression.data else form.operator.data,
+                            expression=form.expression.data or None)
         equation.calculate()
         db.session.add(equation)
         db.session.commit()
         flash('Equation has been submitted!')
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
-    equations = current_user.followed_equations().paginate(page, current_app.config['EQUATIONS_PER_PAGE'], False)
-    next_url = url_for('main.index', page=equations.next_num) if equations.has_next else None
-    prev_url = url_for('main.index', page=equations.prev_num) if equations.has_prev else None
+    # authors are joined into every feed query, rendering a page must not load them one row at a time
+    sources = [(query.options(joinedload(Equation.author)), columns)
+               for query, columns in current_user.followed_equation_sources()]
+    equations = keyset_paginate(sources, current_app.config['EQUATIONS_PER_PAGE'],
+                                after=request.args.get('after'), before=request.args.get('before'))
+    next_url = url_for('main.index', after=equations.next_cursor) if equations.has_next else None
+    prev_url = url_for('main.index', before=equations.prev_cursor) if equations.has_prev else None
     return render_template('index.html', title='Home', form=form, equations=equations.items, next_url=next_url,
                            prev_url=prev_url)
 
 
+@bp.route('/equations/batch', methods=['POST'])
+@login_required
+def batch_equations():
+    triples = (request.get_json(silent=True) or {}).get('equations')
+    if isinstance(triples, list) is False:
+        return jsonify({'error': 'Expected a JSON object with an "equations" list.'}), 400
+    if len(triples) > current_app.config['EQUATIONS_PER_BATCH']:
+        return jsonify({'error': f'At most {current_app.config["EQUATIONS_PER_BATCH"]} equations per batch.'}), 413
+    rows, errors = Equation.evaluate_batch(triples)
+    created = Equation.insert_batch(current_user, rows)
+    db.session.commit()
+    return jsonify({
+        'created': created,
+        'results': [{'error': errors[i]} if row is None else
+                    {'equation_result': row['equation_result'], 'equation_str': row['equation_str']}
+                    for i, row in enumerate(rows)]
+    })
+
+
 @bp.route('/user/<username>')
 @login_required
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    equations = user.equations.order_by(Equation.timestamp.desc()).paginate(
-        page, current_app.config['EQUATIONS_PER_PAGE'], False)
-    next_url = url_for('main.user', page=equations.next_num) if equations.has_next else None
-    prev_url = url_for('main.user', page=equations.prev_num) if equations.has_prev else None
+    feed = render_feed(user.equations.options(joinedload(Equation.author)), [f'equations:{user.id}'], 'main.user',
+                       username=username)
     form = EmptyForm()
-    return render_template('user.html', user=user, equations=equations.items, next_url=next_url,
-                           prev_url=prev_url, form=form)
+    return render_template('user.html', user=user, feed=feed, form=form)
 
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
@@ -108,13 +175,23 @@ def unfollow(username):
 @bp.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
-    equations = Equation.query.order_by(Equation.timestamp.desc()).paginate(page,
-                                                                            current_app.config['EQUATIONS_PER_PAGE'],
-                                                                            False)
-    next_url = url_for('main.explore', page=equations.next_num) if equations.has_next else None
-    prev_url = url_for('main.explore', page=equations.prev_num) if equations.has_prev else None
-    return render_template('index.html', title='Explore', equations=equations.items, next_url=next_url,
+    feed = render_feed(Equation.query.options(joinedload(Equation.author)), ['explore'], 'main.explore')
+    return render_template('index.html', title='Explore', feed=feed)
+
+
+@bp.route('/search')
+@login_required
+def search():
+    q = request.args.get('q', '').strip()
+    if len(q) == 0:
+        return redirect(url_for('main.explore'))
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = current_app.config['EQUATIONS_PER_PAGE']
+    equations, total = Equation.search(q, page, per_page)
+    equations = equations.options(joinedload(Equation.author))
+    next_url = url_for('main.search', q=q, page=page + 1) if total > page * per_page else None
+    prev_url = url_for('main.search', q=q, page=page - 1) if page > 1 else None
+    return render_template('index.html', title='Search', equations=equations.all(), next_url=next_url,
                            prev_url=prev_url)
 
 
@@ -127,6 +204,9 @@ def send_message(recipient):
         msg = Message(author=current_user, recipient=user,
                       body=form.message.data)
         db.session.add(msg)
+        db.session.flush()
+        # the counter was incremented in SQL by the flush
+        db.session.expire(user, ['unread_message_count'])
         user.add_notification('unread_message_count', user.new_messages())
         db.session.commit()
         flash('Your message has been sent.')
@@ -145,26 +225,86 @@ def user_popup(username):
 @login_required
 def messages():
     current_user.last_message_read_time = datetime.utcnow()
+    current_user.unread_message_count = 0
     current_user.add_notification('unread_message_count', 0)
     db.session.commit()
-    page = request.args.get('page', 1, type=int)
-    messages = current_user.messages_received.order_by(
-        Message.timestamp.desc()).paginate(
-            page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.messages', page=messages.next_num) \
-        if messages.has_next else None
-    prev_url = url_for('main.messages', page=messages.prev_num) \
-        if messages.has_prev else None
+    messages = keyset_paginate(current_user.messages_received.options(joinedload(Message.author)),
+                               current_app.config['POSTS_PER_PAGE'],
+                               after=request.args.get('after'), before=request.args.get('before'))
+    next_url = url_for('main.messages', after=messages.next_cursor) if messages.has_next else None
+    prev_url = url_for('main.messages', before=messages.prev_cursor) if messages.has_prev else None
     return render_template('messages.html', messages=messages.items,
+                           avatars=User.avatar_urls([message.author for message in messages.items], 70),
                            next_url=next_url, prev_url=prev_url)
 
-bp.route('/notifications')
+
+@bp.route('/export')
+@login_required
+def export():
+    # ?format=csv|ndjson, ?feed=1 for the home timeline, ?gzip=1 to compress
+    export_format = request.args.get('format', 'csv')
+    if export_format not in FORMATS:
+        abort(400)
+    feed = request.args.get('feed', 0, type=int) == 1
+    compress = request.args.get('gzip', 0, type=int) == 1
+    filename = '{}-{}.{}{}'.format(current_user.username, 'feed' if feed else 'equations', export_format,
+                                   '.gz' if compress else '')
+    headers = {'Content-Disposition': f'attachment; filename="{filename}"', 'X-Accel-Buffering': 'no'}
+    # the rows are read while the response is sent, so the request context and its session are kept open until
+    # the last chunk
+    chunks = export_equations(current_user, export_format, feed, compress, current_app.config['EXPORT_CHUNK_SIZE'])
+    return Response(stream_with_context(chunks), headers=headers,
+                    mimetype='application/gzip' if compress else FORMATS[export_format])
+
+
+@bp.route('/notifications')
 @login_required
 def notifications():
     since = request.args.get('since', 0.0, type=float)
     notifications = current_user.notifications.filter(Notification.timestamp > since).order_by(Notification.timestamp.asc())
-    return jsonify([{
-        'name': n.name,
-        'data': n.get_data(),
-        'timestamp': n.timestamp
-    } for n in notifications])
+    return jsonify([n.to_dict() for n in notifications])
+
+
+@bp.route('/notifications/stream')
+@login_required
+def notification_stream():
+    # browsers reconnect with the id of the last event they saw, which is the notification timestamp
+    since = request.headers.get('Last-Event-ID', type=float) or request.args.get('since', 0.0, type=float)
+    user_id = current_user.id
+    hub = current_app.notification_hub
+    heartbeat = current_app.config['NOTIFICATION_HEARTBEAT']
+    # subscribe before reading the backlog so nothing committed in between is missed
+    listener = hub.subscribe(user_id)
+    if listener is None:
+        return Response('Too many open notification streams.', status=503, headers={'Retry-After': '30'})
+    try:
+        backlog = [n.to_dict() for n in current_user.notifications.filter(
+            Notification.timestamp > since).order_by(Notification.timestamp.asc())]
+    except Exception:
+        # the generator that would unsubscribe never starts
+        hub.unsubscribe(user_id, listener)
+        raise
+
+    def stream():
+        last_sent = since
+        try:
+            yield f'retry: {heartbeat * 1000}\n\n'
+            for notification in backlog:
+                last_sent = notification['timestamp']
+                yield format_event(notification)
+            while True:
+                try:
+                    notification = listener.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                if notification['timestamp'] > last_sent:
+                    last_sent = notification['timestamp']
+                    yield format_event(notification)
+        finally:
+            hub.unsubscribe(user_id, listener)
+
+    # the stream runs after the request context is gone and never touches the database, so the session's
+    # connection is returned to the pool as soon as this view returns
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -1,31 +1,130 @@
-from datetime import datetime, time
-from hashlib import md5
+import secrets
+from datetime import datetime, time, timedelta
+from hashlib import md5, sha256
 
 import jwt
+import numpy as np
 from flask import current_app
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.sql import ClauseElement
 
 from app import db, login
+from app.cache import invalidate_on_commit, invalidate_after_commit, discard_after_soft_rollback
+from app.search import query_index, index_action, delete_action
+from app.expressions import BINARY_OPERATORS, DIVIDE_BY_ZERO_MESSAGE, ExpressionError, binary_expression, \
+    compile_expression
 
 import json
 from time import time
 
+AVATAR_URL = 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'
+
 # this table only contains foreign keys so it is not declared as a model class
 followers = db.Table('followers',
                      db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-                     db.Column('followed_id', db.Integer, db.ForeignKey('user.id')))
+                     db.Column('followed_id', db.Integer, db.ForeignKey('user.id')),
+                     # is_following() and followed lists, and the reverse for fan-out and followers lists
+                     db.Index('ix_followers_follower_id_followed_id', 'follower_id', 'followed_id', unique=True),
+                     db.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id'))
+
+# materialized home feeds: one row per (reader, equation), written when the equation is created (fan-out on write)
+timeline = db.Table('timeline',
+                    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                    db.Column('equation_id', db.Integer, db.ForeignKey('equation.id'), primary_key=True),
+                    db.Column('timestamp', db.DateTime, nullable=False),
+                    db.Index('ix_timeline_user_id_timestamp', 'user_id', 'timestamp', 'equation_id'))
+
+
+class SearchableMixin(object):
+    @classmethod
+    def search(cls, expression, page, per_page):
+        ids, total = query_index(cls.__tablename__, expression, page, per_page)
+        if not ids:
+            # nothing matched, or the page is past the last hit
+            return cls.query.filter_by(id=0), total
+        return cls.query.filter(cls.id.in_(ids)).order_by(
+            db.case({id: i for i, id in enumerate(ids)}, value=cls.id)), total
+
+    @classmethod
+    def index_after_flush(cls, session, flush_context):
+        # ids and values are final once flushed, the actions are handed to the indexer only if the commit succeeds
+        if current_app.search_backend is None:
+            return
+        actions = session.info.setdefault('search_actions', [])
+        for obj in session.new | session.dirty:
+            if isinstance(obj, SearchableMixin) and session.is_modified(obj, include_collections=False):
+                actions.append(index_action(obj.__tablename__, obj, obj.__searchable__))
+        for obj in session.deleted:
+            if isinstance(obj, SearchableMixin):
+                actions.append(delete_action(obj.__tablename__, obj))
+
+    @classmethod
+    def index_where(cls, condition):
+        # rows inserted through Core bypass the flush hook, they are read back and indexed on commit as well
+        if current_app.search_backend is None:
+            return
+        columns = [cls.id] + [getattr(cls, field) for field in cls.__searchable__]
+        rows = db.session.query(*columns).filter(condition)
+        db.session.info.setdefault('search_actions', []).extend(
+            index_action(cls.__tablename__, row, cls.__searchable__) for row in rows)
+
+    @classmethod
+    def index_after_commit(cls, session):
+        actions = session.info.pop('search_actions', None)
+        if actions:
+            current_app.search_indexer.enqueue(actions)
+
+    @classmethod
+    def index_after_soft_rollback(cls, session, previous_transaction):
+        session.info.pop('search_actions', None)
+
+    @classmethod
+    def reindex(cls, chunk_size=1000, condition=None):
+        # streams the table, or the rows matching condition, through the bulk API without hydrating model objects
+        if current_app.search_backend is None:
+            return 0
+        count, batch = 0, []
+        columns = [cls.id] + [getattr(cls, field) for field in cls.__searchable__]
+        query = db.session.query(*columns)
+        if condition is not None:
+            query = query.filter(condition)
+        for row in query.order_by(cls.id).yield_per(chunk_size):
+            batch.append(index_action(cls.__tablename__, row, cls.__searchable__))
+            if len(batch) == chunk_size:
+                current_app.search_indexer.send(batch)
+                count, batch = count + len(batch), []
+        if batch:
+            current_app.search_indexer.send(batch)
+        return count + len(batch)
 
 
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    # the session user is rebuilt from a per-process cache of its row and merged into the session without a
+    # SELECT. writes to the row drop the entry once they commit, USER_CACHE_TIMEOUT bounds how long other
+    # processes can serve a stale copy
+    key = f'user:{int(id)}'
+    values = current_app.user_cache.get(key)
+    if values is not None:
+        user = User(**values)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+    user = User.query.get(int(id))
+    if user is not None:
+        current_app.user_cache.set(key, {attr.key: getattr(user, attr.key) for attr in inspect(User).column_attrs})
+    return user
 
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
+    # md5 of the lowercased email, kept in step with email so avatar URLs cost no hashing
+    avatar_hash = db.Column(db.String(32))
     password_hash = db.Column(db.String(128))
     equations = db.relationship('Equation', backref='author',
                                 lazy='dynamic')  # one-to-many relationships defined on one side
@@ -43,53 +142,192 @@ class User(UserMixin, db.Model):
                                         foreign_keys='Message.recipient_id',
                                         backref='recipient', lazy='dynamic')
     last_message_read_time = db.Column(db.DateTime)
+    unread_message_count = db.Column(db.Integer, default=0, nullable=False)
+    # set once a user has more than TIMELINE_FANOUT_LIMIT followers, their equations are then merged into home
+    # feeds on read instead of being copied into every follower's timeline
+    fanout_on_read = db.Column(db.Boolean, default=False, nullable=False)
+    # denormalized counts, kept up to date by follow(), unfollow(), Equation.after_insert(), Message.after_flush()
+    # and the messages view
+    followers_count = db.Column(db.Integer, default=0, nullable=False)
+    following_count = db.Column(db.Integer, default=0, nullable=False)
+    equations_count = db.Column(db.Integer, default=0, nullable=False)
+    # API bearer tokens, only their sha256 is stored
+    token_hash = db.Column(db.String(64), index=True, unique=True)
+    token_expiration = db.Column(db.DateTime)
 
     def new_messages(self):
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        return Message.query.filter_by(recipient=self).filter(
-            Message.timestamp > last_read_time).count()
+        # the counter is part of the user row flask-login already loaded, so the navbar badge costs no query
+        return self.unread_message_count or 0
 
     def add_notification(self, name, data):
-        self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
+        # repeated notifications are coalesced until the transaction commits, Notification.before_commit then
+        # upserts only the latest one per (user, name)
+        n = {'name': name, 'data': data, 'timestamp': time()}
+        db.session.info.setdefault('notifications', {})[(self, name)] = n
         return n
 
     def __repr__(self):
         return f"<User {self.username}>"
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = current_app.password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        # a hash made under an older policy is replaced while the plain password is at hand, the caller commits
+        hasher = current_app.password_hasher
+        if hasher.verify(self.password_hash, password) is False:
+            return False
+        if hasher.needs_rehash(self.password_hash):
+            self.password_hash = hasher.hash(password)
+        return True
+
+    @staticmethod
+    def email_digest(email):
+        return md5(email.lower().encode('utf-8')).hexdigest() if email else None
+
+    @db.validates('email')
+    def validate_email(self, key, email):
+        self.avatar_hash = self.email_digest(email)
+        return email
 
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+        return AVATAR_URL.format(self.avatar_hash or self.email_digest(self.email), size)
+
+    @staticmethod
+    def avatar_urls(users, size):
+        # user id -> avatar URL, one entry per distinct user of a page
+        urls = {}
+        for user in users:
+            if user.id not in urls:
+                urls[user.id] = user.avatar(size)
+        return urls
 
     def follow(self, user):
         if self.is_following(user) is False:
             self.followed.append(user)
+            self.increment('following_count', 1)
+            user.increment('followers_count', 1)
+            if not user.fanout_on_read:
+                self.backfill_timeline(user)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            self.increment('following_count', -1)
+            user.increment('followers_count', -1)
+            db.session.execute(timeline.delete().where(
+                timeline.c.user_id == self.id,
+                timeline.c.equation_id.in_(db.select(Equation.id).where(Equation.user_id == user.id))))
+
+    def backfill_timeline(self, user):
+        # copies every equation of user into this user's timeline, newest first and TIMELINE_BACKFILL rows at a
+        # time, so the timeline holds the author's whole history as the fan-out on read path does
+        batch_size = current_app.config['TIMELINE_BACKFILL']
+        query = db.select(Equation.id, Equation.timestamp).where(Equation.user_id == user.id).order_by(
+            Equation.timestamp.desc(), Equation.id.desc()).limit(batch_size)
+        rows = db.session.execute(query).all()
+        while rows:
+            db.session.execute(timeline.insert(), [{'user_id': self.id, 'equation_id': id, 'timestamp': timestamp}
+                                                   for id, timestamp in rows])
+            if len(rows) < batch_size:
+                break
+            last_id, last_timestamp = rows[-1]
+            rows = db.session.execute(query.where(db.or_(
+                Equation.timestamp < last_timestamp,
+                db.and_(Equation.timestamp == last_timestamp, Equation.id < last_id)))).all()
 
     def is_following(self, user):
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        return db.session.query(followers.c.follower_id).filter(
+            followers.c.follower_id == self.id, followers.c.followed_id == user.id).first() is not None
+
+    def increment(self, counter, delta):
+        # counters are incremented in SQL so concurrent transactions can't lose updates
+        state = inspect(self)
+        pending = state.dict.get(counter)
+        if isinstance(pending, ClauseElement):
+            setattr(self, counter, pending + delta)
+        elif state.has_identity is False:
+            setattr(self, counter, (pending or 0) + delta)
+        else:
+            setattr(self, counter, getattr(User, counter) + delta)
+
+    @staticmethod
+    def reconcile_counters():
+        # recomputes every counter from the source tables with a single UPDATE
+        return db.session.execute(db.update(User).values(
+            followers_count=db.select(db.func.count()).where(
+                followers.c.followed_id == User.id).scalar_subquery(),
+            following_count=db.select(db.func.count()).where(
+                followers.c.follower_id == User.id).scalar_subquery(),
+            equations_count=db.select(db.func.count()).where(
+                Equation.user_id == User.id).scalar_subquery(),
+            unread_message_count=db.select(db.func.count()).where(
+                Message.recipient_id == User.id,
+                Message.timestamp > db.func.coalesce(User.last_message_read_time, datetime(1900, 1, 1)))
+            .scalar_subquery())).rowcount
+
+    def followed_equation_sources(self):
+        # (query, keyset columns) pairs for keyset_paginate: the materialized timeline, plus the equations of
+        # followed users that are fanned out on read
+        fanned_out = Equation.query.join(timeline, timeline.c.equation_id == Equation.id).filter(
+            timeline.c.user_id == self.id)
+        sources = [(fanned_out, (timeline.c.timestamp, timeline.c.equation_id))]
+        on_read = [id for id, in self.followed.filter(User.fanout_on_read.is_(True)).with_entities(User.id)]
+        if on_read:
+            sources.append((Equation.query.filter(Equation.user_id.in_(on_read)), None))
+        return sources
 
     def followed_equations(self):
-        followed = Equation.query.join(
-            followers, (followers.c.followed_id == Equation.user_id)).filter(
-            followers.c.follower_id == self.id)
-        own = Equation.query.filter_by(user_id=self.id)
-        return followed.union(own).order_by(Equation.timestamp.desc())
+        queries = [query for query, columns in self.followed_equation_sources()]
+        if len(queries) > 1:
+            return queries[0].union(*queries[1:]).order_by(Equation.timestamp.desc())
+        return queries[0].order_by(Equation.timestamp.desc())
+
+    @staticmethod
+    def uncache(*ids):
+        # dropped from the user loader cache once the transaction commits
+        db.session.info.setdefault('uncached_users', set()).update(ids)
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        for obj in session.dirty | session.deleted:
+            if isinstance(obj, User) and session.is_modified(obj):
+                cls.uncache(obj.id)
+                # cached equation pages show the author's name and avatar
+                state = inspect(obj)
+                if state.attrs.username.history.has_changes() or state.attrs.email.history.has_changes():
+                    invalidate_on_commit(f'profile:{obj.id}')
+
+    @staticmethod
+    def uncache_after_commit(session):
+        for id in session.info.pop('uncached_users', ()):
+            current_app.user_cache.delete(f'user:{id}')
+
+    @staticmethod
+    def uncache_after_soft_rollback(session, previous_transaction):
+        session.info.pop('uncached_users', None)
 
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode({'reset_password': self.id, 'exp': (time() + expires_in)},
                           current_app.config['SECRET KEY'], algorithm='HS256')
 
+    def get_token(self, expires_in=3600):
+        # a new token replaces the previous one, the plain token is only ever returned here
+        token = secrets.token_urlsafe(32)
+        self.token_hash = sha256(token.encode('utf-8')).hexdigest()
+        self.token_expiration = datetime.utcnow() + timedelta(seconds=expires_in)
+        return token
+
+    def revoke_token(self):
+        self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+
+    @staticmethod
+    def check_token(token):
+        user = User.query.filter_by(token_hash=sha256(token.encode('utf-8')).hexdigest()).first()
+        if user is None or user.token_expiration < datetime.utcnow():
+            return None
+        return user
+
     @staticmethod
     def verify_reset_password_token(token):
         try:
@@ -100,15 +338,19 @@ class User(UserMixin, db.Model):
         return User.query.get(id)
 
 
-class Equation(db.Model):
-    __searchable__ = ['equation_result']
+class Equation(SearchableMixin, db.Model):
+    __searchable__ = ['equation_str', 'equation_result', 'x_var', 'y_var']
+    # keyset pages of one author's equations and of all equations
+    __table_args__ = (db.Index('ix_equation_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+                      db.Index('ix_equation_timestamp_id', 'timestamp', 'id'))
     id = db.Column(db.Integer, primary_key=True)
     x_var = db.Column(db.Float)
     y_var = db.Column(db.Float)
     operator = db.Column(db.String())
+    expression = db.Column(db.String(140))
     equation_result = db.Column(db.Float)
     equation_str = db.Column(db.String())
-    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
     def __repr__(self):
@@ -118,19 +360,140 @@ class Equation(db.Model):
             <timestamp: {self.timestamp}, user_id: {self.user_id}>'''
 
     def calculate(self):
-        if self.operator == '+':
-            self.equation_result = self.x_var + self.y_var
-        elif self.operator == '-':
-            self.equation_result = self.x_var - self.y_var
-        elif self.operator == '*':
-            self.equation_result = self.x_var * self.y_var
-        elif self.operator == '/':
-            self.equation_result = self.x_var / self.y_var
+        if self.expression:
+            compiled = compile_expression(self.expression)
+            self.expression = compiled.normalized
+        else:
+            compiled = compile_expression(binary_expression(self.operator))
+        self.equation_result = compiled.evaluate(self.x_var, self.y_var)
+        self.equation_str = Equation.format_equation(self.x_var, self.operator, self.y_var, self.equation_result,
+                                                     compiled if self.expression else None)
 
-        self.equation_str = f'{self.x_var:,.2f} {self.operator} {self.y_var:,.2f} = {self.equation_result:,.2f}'
+    @staticmethod
+    def format_equation(x_var, operator, y_var, equation_result, expression=None):
+        if expression is None:
+            return f'{x_var:,.2f} {operator} {y_var:,.2f} = {equation_result:,.2f}'
+        values = ', '.join(f'{name} = {value:,.2f}' for name, value in (('x', x_var), ('y', y_var))
+                           if name in expression.variables)
+        return f'{expression.normalized} = {equation_result:,.2f}' + (f' ({values})' if values else '')
+
+    @classmethod
+    def evaluate_batch(cls, triples):
+        # evaluates (x_var, operator or expression, y_var) triples as arrays, one compiled expression at a time.
+        # returns a list aligned with triples holding either the row to insert or None, and a dict of
+        # rejected index -> error message
+        errors = {}
+        groups = {}
+        x_vars = np.zeros(len(triples))
+        y_vars = np.zeros(len(triples))
+        for i, triple in enumerate(triples):
+            try:
+                x_var, operator, y_var = triple
+                x_var, y_var = float(x_var), float(y_var)
+            except (TypeError, ValueError):
+                errors[i] = 'Each equation must be an [x_var, operator, y_var] triple of numbers.'
+                continue
+            if not (np.isfinite(x_var) and np.isfinite(y_var)):
+                errors[i] = 'Values must be finite numbers.'
+                continue
+            if isinstance(operator, str) is False:
+                errors[i] = f'Unknown operator {operator!r}.'
+                continue
+            try:
+                compiled = compile_expression(
+                    binary_expression(operator) if operator in BINARY_OPERATORS else operator)
+            except ExpressionError as e:
+                errors[i] = str(e)
+                continue
+            x_vars[i], y_vars[i] = x_var, y_var
+            groups.setdefault((operator if operator in BINARY_OPERATORS else None, compiled), []).append(i)
+
+        results = np.full(len(triples), np.nan)
+        for (operator, compiled), indexes in groups.items():
+            indexes = np.array(indexes)
+            if operator == '/':
+                # same rule as EquationForm.validate_y_var, applied per element
+                for i in indexes[y_vars[indexes] == 0]:
+                    errors[int(i)] = DIVIDE_BY_ZERO_MESSAGE
+                indexes = indexes[y_vars[indexes] != 0]
+            results[indexes] = compiled.evaluate_array(x_vars[indexes], y_vars[indexes])
+
+        rows = [None] * len(triples)
+        for (operator, compiled), indexes in groups.items():
+            for i in indexes:
+                if i in errors:
+                    continue
+                x_var, y_var, result = float(x_vars[i]), float(y_vars[i]), float(results[i])
+                if not np.isfinite(result):
+                    # the scalar evaluation says why, with the same message calculate() would give
+                    try:
+                        compiled.evaluate(x_var, y_var)
+                        errors[i] = f'{compiled.normalized} is undefined for x = {x_var}, y = {y_var}.'
+                    except ExpressionError as e:
+                        errors[i] = str(e)
+                    continue
+                rows[i] = {'x_var': x_var, 'y_var': y_var, 'operator': operator,
+                           'expression': None if operator else compiled.normalized,
+                           'equation_result': result,
+                           'equation_str': Equation.format_equation(x_var, operator, y_var, result,
+                                                                    None if operator else compiled)}
+        return rows, errors
+
+    @classmethod
+    def insert_batch(cls, author, rows):
+        # a single executemany INSERT for the whole batch, committed by the caller. pending follows have to be
+        # flushed first, the fan-out reads them with plain SQL
+        db.session.flush()
+        now = datetime.utcnow()
+        rows = [dict(row, user_id=author.id, timestamp=now) for row in rows if row is not None]
+        if rows:
+            db.session.execute(cls.__table__.insert(), rows)
+            inserted = db.and_(cls.user_id == author.id, cls.timestamp == now)
+            cls.after_insert(db.session.connection(), author.id, len(rows), inserted)
+            cls.index_where(inserted)
+        return len(rows)
+
+    @classmethod
+    def after_insert(cls, connection, author_id, count, condition):
+        # bookkeeping for `count` new equations of one author, matched by condition. the same UPDATE moves authors
+        # with more than TIMELINE_FANOUT_LIMIT followers to fan-out on read, where they stay so none of their
+        # equations drop out of feeds
+        connection.execute(db.update(User).where(User.id == author_id).values(
+            equations_count=User.equations_count + count,
+            fanout_on_read=db.or_(User.fanout_on_read,
+                                  User.followers_count > current_app.config['TIMELINE_FANOUT_LIMIT'])))
+        User.uncache(author_id)
+        cls.fan_out(connection, author_id, condition)
+        invalidate_on_commit('explore', f'equations:{author_id}')
+
+    @classmethod
+    def fan_out(cls, connection, author_id, condition):
+        # copies the author's equations matching condition into the author's timeline and, unless the author is
+        # fanned out on read, into the timeline of every follower
+        columns = ['user_id', 'equation_id', 'timestamp']
+        connection.execute(timeline.insert().from_select(
+            columns, db.select(cls.user_id, cls.id, cls.timestamp).where(condition)))
+        # the author's fanout_on_read is read by the INSERT itself, no separate SELECT is needed
+        connection.execute(timeline.insert().from_select(
+            columns, db.select(followers.c.follower_id, cls.id, cls.timestamp)
+            .join_from(followers, cls, followers.c.followed_id == cls.user_id)
+            .join(User, User.id == cls.user_id)
+            .where(followers.c.followed_id == author_id, User.fanout_on_read.is_(False), condition)))
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        new = {}
+        for obj in session.new:
+            if isinstance(obj, Equation):
+                new.setdefault(obj.user_id, []).append(obj.id)
+        for author_id, ids in new.items():
+            if author_id is not None:
+                cls.after_insert(session.connection(), author_id, len(ids), cls.id.in_(ids))
 
 
 class Message(db.Model):
+    # keyset pages of a user's inbox and the unread count
+    __table_args__ = (db.Index('ix_message_recipient_id_timestamp', 'recipient_id', 'timestamp', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -140,8 +503,21 @@ class Message(db.Model):
     def __repr__(self):
         return '<Message {}>'.format(self.body)
 
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        # unread counters of the recipients of new messages, however the messages were added
+        new = {}
+        for obj in session.new:
+            if isinstance(obj, Message) and obj.recipient_id is not None:
+                new[obj.recipient_id] = new.get(obj.recipient_id, 0) + 1
+        for recipient_id, count in new.items():
+            session.connection().execute(db.update(User).where(User.id == recipient_id).values(
+                unread_message_count=User.unread_message_count + count))
+            User.uncache(recipient_id)
+
 
 class Notification(db.Model):
+    __table_args__ = (db.Index('ix_notification_user_id_name', 'user_id', 'name', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -150,3 +526,60 @@ class Notification(db.Model):
 
     def get_data(self):
         return json.loads(str(self.payload_json))
+
+    def to_dict(self):
+        return {'name': self.name, 'data': self.get_data(), 'timestamp': self.timestamp}
+
+    @classmethod
+    def upsert(cls, session, rows):
+        dialect = session.get_bind().dialect.name
+        if dialect in ('sqlite', 'postgresql'):
+            insert = sqlite_insert if dialect == 'sqlite' else postgresql_insert
+            statement = insert(cls.__table__)
+            session.execute(statement.on_conflict_do_update(
+                index_elements=['user_id', 'name'],
+                set_={'payload_json': statement.excluded.payload_json, 'timestamp': statement.excluded.timestamp}),
+                rows)
+            return
+        for row in rows:
+            updated = session.execute(cls.__table__.update().where(
+                cls.user_id == row['user_id'], cls.name == row['name']).values(
+                payload_json=row['payload_json'], timestamp=row['timestamp'])).rowcount
+            if updated == 0:
+                session.execute(cls.__table__.insert().values(**row))
+
+    @classmethod
+    def before_commit(cls, session):
+        pending = session.info.pop('notifications', None)
+        if not pending:
+            return
+        session.flush()
+        published = [(user.id, n) for (user, name), n in pending.items()]
+        cls.upsert(session, [{'user_id': user_id, 'name': n['name'], 'payload_json': json.dumps(n['data']),
+                              'timestamp': n['timestamp']} for user_id, n in published])
+        session.info['published_notifications'] = published
+
+    @classmethod
+    def after_commit(cls, session):
+        for user_id, notification in session.info.pop('published_notifications', []):
+            current_app.notification_hub.publish(user_id, notification)
+
+    @classmethod
+    def after_soft_rollback(cls, session, previous_transaction):
+        session.info.pop('notifications', None)
+        session.info.pop('published_notifications', None)
+
+
+db.event.listen(db.session, 'after_flush', Equation.after_flush)
+db.event.listen(db.session, 'after_flush', User.after_flush)
+db.event.listen(db.session, 'after_flush', Message.after_flush)
+db.event.listen(db.session, 'after_commit', User.uncache_after_commit)
+db.event.listen(db.session, 'after_soft_rollback', User.uncache_after_soft_rollback)
+db.event.listen(db.session, 'after_commit', invalidate_after_commit)
+db.event.listen(db.session, 'after_soft_rollback', discard_after_soft_rollback)
+db.event.listen(db.session, 'after_flush', SearchableMixin.index_after_flush)
+db.event.listen(db.session, 'after_commit', SearchableMixin.index_after_commit)
+db.event.listen(db.session, 'after_soft_rollback', SearchableMixin.index_after_soft_rollback)
+db.event.listen(db.session, 'before_commit', Notification.before_commit)
+db.event.listen(db.session, 'after_commit', Notification.after_commit)
+db.event.listen(db.session, 'after_soft_rollback', Notification.after_soft_rollback)
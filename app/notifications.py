@@ -0,0 +1,57 @@
+import json
+import queue
+import threading
+
+
+class NotificationHub(object):
+    # in-process pub/sub feeding the server-sent event streams, fed by User.add_notification once the
+    # notification is committed. every connected browser gets a small queue of its own, so a slow client only
+    # ever loses its own oldest events.
+    #
+    # each open stream occupies a worker for as long as the browser stays connected, so idle streams are only
+    # cheap under a gevent or eventlet worker (gunicorn -k gevent). the hub only reaches the streams of its own
+    # process, so the app has to run as a single worker process for every stream to see every event. at most
+    # max_listeners streams are held per process, the view answers 503 beyond that
+    def __init__(self, queue_size=100, max_listeners=1000):
+        self.queue_size = queue_size
+        self.max_listeners = max_listeners
+        self.lock = threading.Lock()
+        self.listeners = {}
+        self.listener_count = 0
+
+    def subscribe(self, user_id):
+        with self.lock:
+            if self.listener_count >= self.max_listeners:
+                return None
+            listener = queue.Queue(maxsize=self.queue_size)
+            self.listeners.setdefault(user_id, set()).add(listener)
+            self.listener_count += 1
+        return listener
+
+    def unsubscribe(self, user_id, listener):
+        with self.lock:
+            listeners = self.listeners.get(user_id, set())
+            if listener in listeners:
+                listeners.remove(listener)
+                self.listener_count -= 1
+            if len(listeners) == 0:
+                self.listeners.pop(user_id, None)
+
+    def publish(self, user_id, notification):
+        with self.lock:
+            listeners = list(self.listeners.get(user_id, ()))
+        for listener in listeners:
+            while True:
+                try:
+                    listener.put_nowait(notification)
+                    break
+                except queue.Full:
+                    try:
+                        listener.get_nowait()
+                    except queue.Empty:
+                        pass
+
+
+def format_event(notification):
+    return 'id: {timestamp}\nevent: {name}\ndata: {data}\n\n'.format(
+        timestamp=notification['timestamp'], name=notification['name'], data=json.dumps(notification))
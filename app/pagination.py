@@ -0,0 +1,81 @@
+import base64
+import binascii
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+
+class KeysetPage(object):
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+# cursors are opaque to clients, they encode the (timestamp, id) of the row at the edge of a page
+def encode_cursor(timestamp, id):
+    raw = f'{timestamp.isoformat()}|{id}'.encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        timestamp, id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+def keyset_paginate(query, per_page, after=None, before=None, columns=None):
+    # pages through query newest first on (timestamp, id) so every page is an index range scan of per_page + 1
+    # rows, no matter how deep it is. `after` pages towards older rows, `before` towards newer ones.
+    # query may also be a list of (query, columns) sources whose pages are merged, rows are then deduplicated by id
+    sources = query if isinstance(query, list) else [(query, columns)]
+    before = decode_cursor(before)
+    after = None if before is not None else decode_cursor(after)
+    newer = before is not None
+
+    rows, seen = [], set()
+    candidates = [row for source, columns in sources
+                  for row in _page_rows(source, columns, before or after, newer, per_page + 1)]
+    for row in sorted(candidates, key=lambda row: (row.timestamp, row.id), reverse=newer is False):
+        if row.id not in seen:
+            seen.add(row.id)
+            rows.append(row)
+    if newer:
+        items = rows[:per_page][::-1]
+        has_next, has_prev = True, len(rows) > per_page
+    else:
+        items = rows[:per_page]
+        has_next, has_prev = len(rows) > per_page, after is not None
+
+    if len(items) == 0:
+        return KeysetPage(items)
+    return KeysetPage(items,
+                      next_cursor=encode_cursor(items[-1].timestamp, items[-1].id) if has_next else None,
+                      prev_cursor=encode_cursor(items[0].timestamp, items[0].id) if has_prev else None)
+
+
+def _page_rows(query, columns, cursor, newer, limit):
+    if columns is None:
+        entity = query.column_descriptions[0]['entity']
+        columns = (entity.timestamp, entity.id)
+    timestamp, id = columns
+    query = query.order_by(None)
+    if newer:
+        return query.filter(or_(timestamp > cursor[0], and_(timestamp == cursor[0], id > cursor[1]))).order_by(
+            timestamp.asc(), id.asc()).limit(limit).all()
+    if cursor is not None:
+        query = query.filter(or_(timestamp < cursor[0], and_(timestamp == cursor[0], id < cursor[1])))
+    return query.order_by(timestamp.desc(), id.desc()).limit(limit).all()
@@ -0,0 +1,66 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordHasherBusy(RuntimeError):
+    pass
+
+
+class PasswordHasher(object):
+    # hashes and verifies passwords on a dedicated pool of `workers` threads, so at most that many key derivations
+    # use the CPU at once however many sign-ins arrive together. callers that find all `workers + queue_size`
+    # slots taken for more than `timeout` seconds get PasswordHasherBusy instead of piling up
+    def __init__(self, method='pbkdf2:sha256:260000', salt_length=16, workers=2, queue_size=32, timeout=10):
+        self.method = method
+        self.salt_length = salt_length
+        # werkzeug fills in defaults such as the iteration count, so the prefix is taken from a real hash
+        self.prefix = generate_password_hash('', method=method, salt_length=1).split('$')[0]
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hasher')
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def hash(self, password):
+        return self.run('hash', generate_password_hash, password, method=self.method, salt_length=self.salt_length)
+
+    def verify(self, pwhash, password):
+        if not pwhash:
+            return False
+        return self.run('verify', check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        # werkzeug hashes look like method$salt$hash, anything not made with the current policy is upgraded
+        parts = (pwhash or '').split('$')
+        return len(parts) != 3 or parts[0] != self.prefix or len(parts[1]) != self.salt_length
+
+    def run(self, operation, func, *args, **kwargs):
+        if self.slots.acquire(timeout=self.timeout) is False:
+            self.record(operation + '_rejected', None)
+            raise PasswordHasherBusy(f'No password hashing slot became free within {self.timeout} seconds')
+        try:
+            started = time.perf_counter()
+            result = self.executor.submit(func, *args, **kwargs).result()
+            self.record(operation, time.perf_counter() - started)
+            return result
+        finally:
+            self.slots.release()
+
+    def record(self, operation, seconds):
+        with self.lock:
+            metric = self.metrics.setdefault(operation, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            metric['count'] += 1
+            if seconds is not None:
+                metric['seconds'] += seconds
+                metric['max_seconds'] = max(metric['max_seconds'], seconds)
+
+    def stats(self):
+        # per operation: calls, total and slowest wall time including the wait for a thread, and the mean
+        with self.lock:
+            stats = {operation: dict(metric) for operation, metric in self.metrics.items()}
+        for metric in stats.values():
+            metric['mean_seconds'] = metric['seconds'] / metric['count'] if metric['count'] else 0.0
+        return stats
@@ -0,0 +1,54 @@
+from flask import current_app
+from sqlalchemy.orm import make_transient_to_detached
+
+from app import db
+from app.models import User, Equation, Message, Notification, followers
+
+
+def hot_queries(user):
+    # name -> statement for the queries behind every page view, built the way the views build them
+    per_page = current_app.config['EQUATIONS_PER_PAGE'] + 1
+    timeline_source, columns = user.followed_equation_sources()[0]
+    return {
+        'home timeline': timeline_source.order_by(columns[0].desc(), columns[1].desc()).limit(per_page),
+        'home timeline, fanned out on read': Equation.query.filter(Equation.user_id.in_([user.id])).order_by(
+            Equation.timestamp.desc(), Equation.id.desc()).limit(per_page),
+        'explore': Equation.query.order_by(Equation.timestamp.desc(), Equation.id.desc()).limit(per_page),
+        'user equations': user.equations.order_by(Equation.timestamp.desc(), Equation.id.desc()).limit(per_page),
+        'is_following': db.session.query(followers.c.follower_id).filter(
+            followers.c.follower_id == user.id, followers.c.followed_id == user.id).limit(1),
+        'followers of an author': db.session.query(followers.c.follower_id).filter(
+            followers.c.followed_id == user.id),
+        'messages': user.messages_received.order_by(Message.timestamp.desc(), Message.id.desc()).limit(
+            current_app.config['POSTS_PER_PAGE'] + 1),
+        # the unread message count is a column of this row, read by the user loader on a cache miss
+        'user by id': User.query.filter_by(id=user.id),
+        'notifications': user.notifications.filter(Notification.timestamp > 0.0).order_by(
+            Notification.timestamp.asc()),
+        'user by username': User.query.filter_by(username=user.username),
+    }
+
+
+def explain(statement):
+    # the plan as (detail, full scan) rows. only SQLite's EXPLAIN QUERY PLAN is understood
+    if hasattr(statement, 'statement'):
+        statement = statement.statement
+    connection = db.session.connection()
+    if connection.dialect.name != 'sqlite':
+        raise RuntimeError(f'EXPLAIN QUERY PLAN is not supported on {connection.dialect.name}')
+    compiled = statement.compile(dialect=connection.dialect, compile_kwargs={'render_postcompile': True})
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+    rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + str(compiled), params).fetchall()
+    # "SCAN table" reads every row, "SCAN table USING INDEX" walks an index in order and stops at the LIMIT
+    return [(detail, detail.startswith('SCAN ') and ' USING ' not in detail) for _, _, _, detail in rows]
+
+
+def check_query_plans():
+    # {name: plan} for every hot query, planned for a stand-in user that is never written
+    user = User(id=0, username='', email='')
+    make_transient_to_detached(user)
+    user = db.session.merge(user, load=False)
+    try:
+        return {name: explain(statement) for name, statement in hot_queries(user).items()}
+    finally:
+        db.session.expunge(user)
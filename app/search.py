@@ -1,27 +1,257 @@
+import atexit
+import queue
+import re
+import sqlite3
+import threading
+import time
+
 from flask import current_app
 
 
 def add_to_index(index, model):
-    if current_app.elasticsearch is None:
+    if current_app.search_backend is None:
         return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    current_app.search_backend.bulk([index_action(index, model, model.__searchable__)])
 
 
 def remove_from_index(index, model):
-    if current_app.elasticsearch is None:
+    if current_app.search_backend is None:
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    current_app.search_backend.bulk([delete_action(index, model)])
 
 
 def query_index(index, query, page, per_page):
-    if current_app.elasticsearch is None:
+    if current_app.search_backend is None:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
+    return current_app.search_backend.query(index, query, page, per_page)
+
+
+def index_action(index, model, fields):
+    return {'op': 'index', 'index': index, 'id': model.id,
+            'source': {field: getattr(model, field) for field in fields}}
+
+
+def delete_action(index, model):
+    return {'op': 'delete', 'index': index, 'id': model.id}
+
+
+def create_search_backend(app):
+    backend = app.config['SEARCH_BACKEND'] or ('elasticsearch' if app.elasticsearch is not None else 'sqlite')
+    if backend == 'elasticsearch':
+        return ElasticsearchBackend(app.elasticsearch, app.logger)
+    if backend == 'sqlite':
+        return SQLiteSearchBackend(app.config['SEARCH_INDEX_PATH'])
+    return None
+
+
+# search backends apply batches of index/delete actions and answer queries with a page of ids and the total hits.
+# bulk() returns the actions that failed transiently and should be retried.
+class ElasticsearchBackend(object):
+    def __init__(self, client, logger):
+        self.client = client
+        self.logger = logger
+
+    def bulk(self, actions):
+        body = []
+        for action in actions:
+            body.append({action['op']: {'_index': action['index'], '_id': action['id']}})
+            if action['op'] == 'index':
+                body.append(action['source'])
+        response = self.client.bulk(body=body)
+        if response.get('errors') is False:
+            return []
+        retry = []
+        for action, item in zip(actions, response['items']):
+            status = list(item.values())[0].get('status', 500)
+            if status == 429 or status >= 500:
+                retry.append(action)
+            elif status >= 400 and (action['op'], status) != ('delete', 404):
+                self.logger.error('Search %s of %s %s failed: %s', action['op'], action['index'], action['id'], item)
+        return retry
+
+    def query(self, index, query, page, per_page):
+        search = self.client.search(
+            index=index,
+            body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
+                  'from': (page - 1) * per_page, 'size': per_page})
+        ids = [int(hit['_id']) for hit in search['hits']['hits']]
+        return ids, search['hits']['total']['value']
+
+
+class SQLiteSearchBackend(object):
+    # embedded search for single node deployments: text fields go into one FTS5 table per index (rowid = model
+    # id) and numeric fields into a table whose (index, field, value) b-tree answers exact and range queries.
+    #
+    # queries are whitespace separated terms that must all match:
+    #   42, 1.5..3         any numeric field equal to / within the range
+    #   x_var:42, x_var:>=3, equation_result:1..10
+    #                      one numeric field, the operators are =, <, <=, > and >=
+    #   sqrt, "x + y"      text, matched by FTS5
+    NUMBER = r'-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+    CONDITION = re.compile(rf'^(?:(?P<low>{NUMBER})\.\.(?P<high>{NUMBER})|(?P<op><=|>=|<|>|=)?(?P<value>{NUMBER}))$')
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.text_tables = set()
+        with self.lock, self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS search_number (
+                    idx TEXT NOT NULL, doc_id INTEGER NOT NULL, field TEXT NOT NULL, value REAL NOT NULL,
+                    PRIMARY KEY (idx, doc_id, field)) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS ix_search_number_field_value ON search_number (idx, field, value);
+                CREATE INDEX IF NOT EXISTS ix_search_number_value ON search_number (idx, value);
+            """)
+
+    def text_table(self, index):
+        table = f'search_text_{index}'
+        if table not in self.text_tables:
+            self.connection.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS "{table}" USING fts5(body)')
+            self.text_tables.add(table)
+        return table
+
+    def bulk(self, actions):
+        with self.lock, self.connection:
+            for action in actions:
+                table = self.text_table(action['index'])
+                self.connection.execute(f'DELETE FROM "{table}" WHERE rowid = ?', (action['id'],))
+                self.connection.execute('DELETE FROM search_number WHERE idx = ? AND doc_id = ?',
+                                        (action['index'], action['id']))
+                if action['op'] != 'index':
+                    continue
+                text, numbers = [], []
+                for field, value in action['source'].items():
+                    if isinstance(value, (int, float)) and isinstance(value, bool) is False:
+                        numbers.append((action['index'], action['id'], field, value))
+                    elif value is not None:
+                        text.append(str(value))
+                self.connection.executemany('INSERT INTO search_number VALUES (?, ?, ?, ?)', numbers)
+                if text:
+                    self.connection.execute(f'INSERT INTO "{table}" (rowid, body) VALUES (?, ?)',
+                                            (action['id'], ' '.join(text)))
+        return []
+
+    def query(self, index, query, page, per_page):
+        clauses, params, text = [], [], []
+        for term in query.split():
+            field, _, condition = term.rpartition(':')
+            match = self.CONDITION.match(condition)
+            if match is None:
+                text.append('"{}"'.format(term.replace('"', '""')))
+                continue
+            sql = 'SELECT doc_id FROM search_number WHERE idx = ?'
+            params.append(index)
+            if field:
+                sql += ' AND field = ?'
+                params.append(field)
+            if match.group('low') is not None:
+                sql += ' AND value BETWEEN ? AND ?'
+                params.extend([float(match.group('low')), float(match.group('high'))])
+            else:
+                sql += f' AND value {match.group("op") or "="} ?'
+                params.append(float(match.group('value')))
+            clauses.append(sql)
+        with self.lock:
+            if text:
+                clauses.append(f'SELECT rowid AS doc_id FROM "{self.text_table(index)}" WHERE body MATCH ?')
+                params.append(' '.join(text))
+            if len(clauses) == 0:
+                return [], 0
+            matches = ' INTERSECT '.join(clauses)
+            total = self.connection.execute(f'SELECT count(*) FROM ({matches})', params).fetchone()[0]
+            ids = self.connection.execute(f'SELECT doc_id FROM ({matches}) ORDER BY 1 DESC LIMIT ? OFFSET ?',
+                                          params + [per_page, (page - 1) * per_page]).fetchall()
+        return [id for id, in ids], total
+
+
+class SearchIndexer(object):
+    # sends queued index/delete actions to the search backend from a background thread using its bulk API, in
+    # batches of at most SEARCH_BATCH_SIZE actions or SEARCH_BATCH_INTERVAL seconds, whichever comes first.
+    # whatever is still queued at exit is sent before the process ends
+    def __init__(self, app):
+        self.app = app
+        self.batch_size = app.config['SEARCH_BATCH_SIZE']
+        self.batch_interval = app.config['SEARCH_BATCH_INTERVAL']
+        self.max_retries = app.config['SEARCH_MAX_RETRIES']
+        self.queue = queue.Queue(maxsize=app.config['SEARCH_QUEUE_SIZE'])
+        self.lock = threading.Lock()
+        self.thread = None
+        self.dropped = 0
+
+    def enqueue(self, actions):
+        # runs after a commit on the request thread, so it never waits for room in the queue
+        self.start()
+        dropped = 0
+        for action in actions:
+            try:
+                self.queue.put_nowait(action)
+            except queue.Full:
+                dropped += 1
+        if dropped:
+            with self.lock:
+                self.dropped += dropped
+            # a full reindex brings the index back in sync
+            self.app.logger.warning('Search queue is full, dropped %d of %d actions', dropped, len(actions))
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or self.thread.is_alive() is False:
+                if self.thread is None:
+                    # an unreachable backend must not hold up the exit for the whole retry schedule
+                    atexit.register(self.stop, timeout=10)
+                self.thread = threading.Thread(target=self.run, name='search-indexer', daemon=True)
+                self.thread.start()
+
+    def stop(self, timeout=None):
+        # sends what is still queued and ends the thread
+        with self.lock:
+            thread = self.thread
+        if thread is not None and thread.is_alive():
+            self.queue.put(None)
+            thread.join(timeout)
+
+    def flush(self):
+        # blocks until everything enqueued so far has been sent
+        self.queue.join()
+
+    def run(self):
+        # None on the queue stops the thread once the actions ahead of it are sent
+        stopping = False
+        while stopping is False:
+            action = self.queue.get()
+            if action is None:
+                self.queue.task_done()
+                return
+            batch = [action]
+            deadline = time.monotonic() + self.batch_interval
+            while len(batch) < self.batch_size:
+                try:
+                    action = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if action is None:
+                    self.queue.task_done()
+                    stopping = True
+                    break
+                batch.append(action)
+            try:
+                self.send(batch)
+            except Exception:
+                self.app.logger.exception('Search indexing of %d actions failed', len(batch))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def send(self, actions):
+        # retries whatever failed transiently with exponential backoff
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                time.sleep(min(2 ** (attempt - 1) * 0.5, 30))
+            try:
+                actions = self.app.search_backend.bulk(actions)
+            except Exception as e:
+                self.app.logger.warning('Search bulk request failed (attempt %d): %s', attempt + 1, e)
+                continue
+            if len(actions) == 0:
+                return
+        raise RuntimeError(f'{len(actions)} search actions still failing after {self.max_retries} retries')
@@ -0,0 +1,136 @@
+"""Compare database engine profiles under a concurrent read/write load.
+
+Each profile gets a fresh SQLite file. Worker threads read explore pages and post equations, as the web
+workers do, and the script reports throughput, latency percentiles and "database is locked" failures.
+
+    python benchmarks/db_profiles.py --threads 8 --seconds 10 --write-ratio 0.2
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy.exc import OperationalError  # noqa: E402
+
+from app import create_app, db  # noqa: E402
+from app.models import User, Equation  # noqa: E402
+from app.pagination import keyset_paginate  # noqa: E402
+from config import Config  # noqa: E402
+
+# config overrides per profile. 'default' is what the app ran with before the profile settings existed
+PROFILES = {
+    'default': dict(SQLITE_JOURNAL_MODE=None, SQLITE_SYNCHRONOUS=None, SQLITE_CACHE_SIZE=None, SQLITE_MMAP_SIZE=None,
+                    SQLITE_BUSY_TIMEOUT=None, DATABASE_POOL_SIZE=0),
+    'wal': dict(DATABASE_POOL_SIZE=0),
+    'wal+pool': dict(),
+}
+
+
+class BenchmarkConfig(Config):
+    TESTING = True
+    SEARCH_BACKEND = 'none'
+    CACHE_TYPE = 'none'
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run_profile(name, overrides, threads, seconds, write_ratio, users):
+    data_dir = tempfile.mkdtemp(prefix='math_app_bench_')
+    config = type('ProfileConfig', (BenchmarkConfig,), dict(
+        overrides, SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(data_dir, 'app.db')))
+    app = create_app(config)
+    with app.app_context():
+        db.create_all()
+        authors = [User(username=f'user{i}', email=f'user{i}@example.com') for i in range(users)]
+        db.session.add_all(authors)
+        db.session.commit()
+        for author in authors:
+            Equation.insert_batch(author, Equation.evaluate_batch([[i, '+', 1] for i in range(20)])[0])
+        db.session.commit()
+        author_ids = [author.id for author in authors]
+
+    results = {'reads': [], 'writes': [], 'locked': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def worker(seed):
+        rng = random.Random(seed)
+        reads, writes, locked = [], [], 0
+        with app.app_context():
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                try:
+                    if rng.random() < write_ratio:
+                        author = db.session.get(User, rng.choice(author_ids))
+                        equation = Equation(x_var=rng.randint(0, 100), y_var=rng.randint(1, 100), operator='*',
+                                            author=author)
+                        equation.calculate()
+                        db.session.add(equation)
+                        db.session.commit()
+                        writes.append(time.perf_counter() - started)
+                    else:
+                        keyset_paginate(Equation.query, app.config['EQUATIONS_PER_PAGE'])
+                        db.session.commit()
+                        reads.append(time.perf_counter() - started)
+                except OperationalError:
+                    db.session.rollback()
+                    locked += 1
+                finally:
+                    db.session.remove()
+        with lock:
+            results['reads'].extend(reads)
+            results['writes'].extend(writes)
+            results['locked'] += locked
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    with app.app_context():
+        db.engine.dispose()
+    shutil.rmtree(data_dir, ignore_errors=True)
+
+    ops = len(results['reads']) + len(results['writes'])
+    return {
+        'profile': name,
+        'ops/s': ops / seconds,
+        'read p50 ms': percentile(results['reads'], 0.5) * 1000,
+        'read p95 ms': percentile(results['reads'], 0.95) * 1000,
+        'write p50 ms': percentile(results['writes'], 0.5) * 1000,
+        'write p95 ms': percentile(results['writes'], 0.95) * 1000,
+        'locked': results['locked'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--profile', action='append', choices=sorted(PROFILES),
+                        help='Profile to run, may be repeated. Defaults to all of them.')
+    args = parser.parse_args()
+
+    rows = [run_profile(name, PROFILES[name], args.threads, args.seconds, args.write_ratio, args.users)
+            for name in args.profile or PROFILES]
+    columns = list(rows[0])
+    print('  '.join(f'{column:>12}' for column in columns))
+    for row in rows:
+        print('  '.join(f'{value:>12.1f}' if isinstance(value, float) else f'{value:>12}' for value in row.values()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+"""Load test the main pages against a large synthetic dataset.
+
+A deterministic social graph is generated with bulk inserts: --users users whose follow counts follow a Pareto
+distribution and whose popularity follows Zipf's law, --equations equations and --messages messages. Worker
+threads then request the pages through the Flask test client as random signed in users, and the script reports
+latency percentiles and SQL queries per request for every page. Results are written as JSON, and a previous
+result given with --baseline is compared against.
+
+    python benchmarks/load_test.py --users 2000 --equations 200000 --messages 20000 --requests 2000 \\
+        --threads 4 --output results.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqlalchemy  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+from app import create_app, db  # noqa: E402
+from app.importer import import_equations  # noqa: E402
+from app.models import User, Message, followers  # noqa: E402
+from config import Config  # noqa: E402
+
+# page name -> url for a random user name
+ROUTES = {
+    'index': lambda username: '/index',
+    'explore': lambda username: '/explore',
+    'user': lambda username: f'/user/{username}',
+    'user_popup': lambda username: f'/user/{username}/popup',
+    'messages': lambda username: '/messages',
+}
+
+OPERATORS = ['+', '-', '*', '/', 'x ** 2 + y', 'sqrt(x) * y']
+
+# generated rows are dated back from here, so the same seed always produces the same database
+EPOCH = datetime(2021, 1, 1)
+
+
+class BenchmarkConfig(Config):
+    TESTING = True
+    SEARCH_BACKEND = 'none'
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def insert_chunks(table, rows, chunk_size):
+    for i in range(0, len(rows), chunk_size):
+        db.session.execute(table.insert(), rows[i:i + chunk_size])
+        db.session.commit()
+
+
+def generate(seed, users, mean_degree, alpha, equations, messages, days, chunk_size):
+    # returns the row counts written. user i is the i-th most popular, so a few users collect most followers and
+    # cross TIMELINE_FANOUT_LIMIT as they would in production
+    rng = random.Random(seed)
+    password_hash = generate_password_hash('benchmark', method='pbkdf2:sha256:1000')
+    usernames = [f'user{i}' for i in range(users)]
+    insert_chunks(User.__table__, [
+        dict(username=name, email=f'{name}@example.com', avatar_hash=User.email_digest(f'{name}@example.com'),
+             password_hash=password_hash, last_seen=EPOCH,
+             last_message_read_time=EPOCH - timedelta(days=days // 2), unread_message_count=0,
+             fanout_on_read=False, followers_count=0, following_count=0, equations_count=0)
+        for name in usernames], chunk_size)
+    ids = [id for id, in db.session.query(User.id).order_by(User.id)]
+
+    cum_weights = list(accumulate(1 / (rank + 1) for rank in range(users)))
+    scale = mean_degree * (alpha - 1) / alpha
+    follows = []
+    for follower_id in ids:
+        degree = min(users - 1, int(scale * rng.paretovariate(alpha)))
+        followed = {ids[i] for i in rng.choices(range(users), cum_weights=cum_weights, k=degree)}
+        followed.discard(follower_id)
+        follows.extend(dict(follower_id=follower_id, followed_id=followed_id) for followed_id in sorted(followed))
+    insert_chunks(followers, follows, chunk_size)
+    User.reconcile_counters()
+    db.session.commit()
+
+    # equations go through the bulk importer, which fans them out to the timelines
+    def records():
+        for i in range(equations):
+            yield {'username': usernames[int(rng.paretovariate(1.2)) % users], 'x_var': rng.randint(0, 1000),
+                   'operator': rng.choice(OPERATORS), 'y_var': rng.randint(1, 1000),
+                   'timestamp': (EPOCH - timedelta(seconds=rng.randrange(days * 86400))).isoformat()}
+    imported, rejected, _ = import_equations(records(), chunk_size, reindex=False)
+
+    insert_chunks(Message.__table__, [
+        dict(sender_id=rng.choice(ids), recipient_id=rng.choice(ids), body=f'Benchmark message {i}',
+             timestamp=EPOCH - timedelta(seconds=rng.randrange(days * 86400)))
+        for i in range(messages)], chunk_size)
+    User.reconcile_counters()
+    db.session.commit()
+    return {'users': users, 'follows': len(follows), 'equations': imported, 'rejected': rejected,
+            'messages': messages,
+            'fanout_on_read': db.session.query(User).filter(User.fanout_on_read.is_(True)).count()}
+
+
+def run(app, usernames, ids, routes, requests, threads, seed):
+    # requests are spread evenly over the routes and threads, each thread with its own test client
+    counter = threading.local()
+    with app.app_context():
+        engine = db.engine
+
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        counter.queries = getattr(counter, 'queries', 0) + 1
+
+    event.listen(engine, 'before_cursor_execute', count_query)
+    results = {name: {'seconds': [], 'queries': [], 'errors': 0} for name in routes}
+    lock = threading.Lock()
+
+    def worker(n):
+        rng = random.Random(seed + n)
+        client = app.test_client()
+        samples = {name: {'seconds': [], 'queries': [], 'errors': 0} for name in routes}
+        for i in range(n, requests, threads):
+            name = routes[i % len(routes)]
+            user = rng.randrange(len(ids))
+            with client.session_transaction() as session:
+                session['_user_id'] = str(ids[user])
+            counter.queries = 0
+            started = time.perf_counter()
+            response = client.get(ROUTES[name](usernames[rng.randrange(len(usernames))]))
+            samples[name]['seconds'].append(time.perf_counter() - started)
+            samples[name]['queries'].append(counter.queries)
+            samples[name]['errors'] += response.status_code >= 400
+        with lock:
+            for name, sample in samples.items():
+                for key in ('seconds', 'queries'):
+                    results[name][key].extend(sample[key])
+                results[name]['errors'] += sample['errors']
+
+    started = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    event.remove(engine, 'before_cursor_execute', count_query)
+
+    report = {}
+    for name, result in results.items():
+        seconds, queries = result['seconds'], result['queries']
+        report[name] = {
+            'requests': len(seconds),
+            'errors': result['errors'],
+            'p50_ms': percentile(seconds, 0.5) * 1000,
+            'p95_ms': percentile(seconds, 0.95) * 1000,
+            'p99_ms': percentile(seconds, 0.99) * 1000,
+            'queries_per_request': sum(queries) / len(queries) if queries else 0.0,
+            'max_queries': max(queries, default=0),
+        }
+    return report, requests / elapsed
+
+
+def print_report(report, baseline=None):
+    columns = ['requests', 'errors', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request']
+    print(f'{"route":>12}  ' + '  '.join(f'{column:>20}' for column in columns))
+    for name, row in report.items():
+        cells = []
+        for column in columns:
+            value = row[column]
+            cell = f'{value:.1f}' if isinstance(value, float) else str(value)
+            if baseline and name in baseline and column != 'requests':
+                before = baseline[name][column]
+                cell += f' ({(value - before) / before * 100:+.0f}%)' if before else ''
+            cells.append(f'{cell:>20}')
+        print(f'{name:>12}  ' + '  '.join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--mean-degree', type=float, default=20, help='Mean number of users each user follows.')
+    parser.add_argument('--alpha', type=float, default=1.5, help='Pareto shape of the follow counts, above 1.')
+    parser.add_argument('--equations', type=int, default=50000)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--days', type=int, default=90, help='Span of the generated timestamps.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=5000, help='Rows per bulk insert.')
+    parser.add_argument('--requests', type=int, default=1000, help='Requests in total, spread over the routes.')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--route', action='append', choices=sorted(ROUTES),
+                        help='Route to request, may be repeated. Defaults to all of them.')
+    parser.add_argument('--fanout-limit', type=int, default=Config.TIMELINE_FANOUT_LIMIT,
+                        help='Followers above which a user is fanned out on read.')
+    parser.add_argument('--cache-type', default='memory', choices=['memory', 'none'])
+    parser.add_argument('--database', help='SQLite file to keep the generated data in, reused if it exists.')
+    parser.add_argument('--output', help='File to write the results to as JSON.')
+    parser.add_argument('--baseline', help='Results of an earlier run to compare against.')
+    args = parser.parse_args()
+    if args.alpha <= 1:
+        parser.error('--alpha must be above 1')
+
+    data_dir = None
+    path = args.database
+    if path is None:
+        data_dir = tempfile.mkdtemp(prefix='math_app_load_')
+        path = os.path.join(data_dir, 'app.db')
+    config = type('LoadTestConfig', (BenchmarkConfig,), dict(
+        SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.abspath(path), CACHE_TYPE=args.cache_type,
+        TIMELINE_FANOUT_LIMIT=args.fanout_limit))
+    exists = os.path.exists(path)
+    app = create_app(config)
+    try:
+        with app.app_context():
+            generated = None
+            if exists is False:
+                db.create_all()
+                started = time.perf_counter()
+                generated = generate(args.seed, args.users, args.mean_degree, args.alpha, args.equations,
+                                     args.messages, args.days, args.chunk_size)
+                generated['seconds'] = time.perf_counter() - started
+                print(f'generated {generated}', file=sys.stderr)
+            users = db.session.query(User.id, User.username).order_by(User.id).all()
+            db.session.remove()
+        report, throughput = run(app, [username for _, username in users], [id for id, _ in users],
+                                 args.route or list(ROUTES), args.requests, args.threads, args.seed)
+    finally:
+        with app.app_context():
+            # written now, not by the exit hook after the database is gone
+            app.last_seen.flush()
+            db.engine.dispose()
+        if data_dir is not None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['routes']
+    print_report(report, baseline)
+    print(f'{throughput:.1f} requests/s')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'parameters': vars(args), 'generated': generated, 'routes': report,
+                       'requests_per_second': throughput, 'finished': datetime.utcnow().isoformat() + 'Z',
+                       'python': platform.python_version(), 'sqlalchemy': sqlalchemy.__version__}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
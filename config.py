@@ -10,13 +10,93 @@ class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'I\'ll never tell!'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # pragmas run on every new SQLite connection, set one to None to keep sqlite's default. WAL lets readers
+    # carry on while a request commits, busy_timeout (ms) makes writers wait for the lock instead of failing
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE') or 'WAL'
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS') or 'NORMAL'
+    SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE') or -64000)
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE') or 256 * 1024 * 1024)
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000)
+    # connection pool of the database engine. recycle and pre-ping only apply to server databases, a pool size
+    # of 0 makes file based SQLite open a connection per checkout again
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 5)
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW') or 10)
+    DATABASE_POOL_TIMEOUT = 30
+    DATABASE_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE') or 1800)
+    DATABASE_POOL_PRE_PING = True
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['frank@email.com']
+    # werkzeug method string for new password hashes, older hashes are upgraded at the next login. run
+    # `flask hash-benchmark` to see what a higher iteration count costs per login
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:260000'
+    PASSWORD_SALT_LENGTH = 16
+    # hashes run on PASSWORD_HASH_WORKERS threads, requests wait up to PASSWORD_HASH_TIMEOUT seconds for one of
+    # the PASSWORD_HASH_QUEUE_SIZE waiting slots before getting a 503
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_QUEUE_SIZE = 32
+    PASSWORD_HASH_TIMEOUT = 10
+    # outgoing mail is sent by MAIL_WORKERS threads that each hold one SMTP connection open until it has been idle
+    # for MAIL_IDLE_TIMEOUT seconds. send_email waits up to MAIL_ENQUEUE_TIMEOUT seconds when the queue is full
+    MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 2)
+    MAIL_QUEUE_SIZE = 1000
+    MAIL_BATCH_SIZE = 50
+    MAIL_IDLE_TIMEOUT = 30
+    MAIL_ENQUEUE_TIMEOUT = 1.0
+    MAIL_MAX_RETRIES = 3
+    MAIL_RETRY_DELAY = 1.0
+    # outside of debug and testing, log records are queued on the request thread and written by a background
+    # listener. LOG_JSON adds JSON lines output to a file, or to stderr when it is '-'
+    LOG_LEVEL = os.environ.get('LOG_LEVEL') or 'INFO'
+    LOG_FILE = os.environ.get('LOG_FILE', os.path.join('logs', 'math_app.log'))
+    LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES') or 10 * 1024 * 1024)
+    LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT') or 10)
+    LOG_FORMAT = os.environ.get('LOG_FORMAT') or '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
+    LOG_JSON = os.environ.get('LOG_JSON')
+    # error emails to ADMINS, at most LOG_MAIL_LIMIT per LOG_MAIL_INTERVAL seconds, repeats of the same error
+    # within LOG_MAIL_DEDUP_WINDOW seconds are dropped
+    LOG_MAIL_LIMIT = 10
+    LOG_MAIL_INTERVAL = 3600
+    LOG_MAIL_DEDUP_WINDOW = 600
     EQUATIONS_PER_PAGE = 15
+    EQUATIONS_PER_BATCH = 10000
+    # bearer tokens for /api/v1 are valid for API_TOKEN_EXPIRES_IN seconds, pages hold at most API_MAX_PER_PAGE rows
+    API_TOKEN_EXPIRES_IN = int(os.environ.get('API_TOKEN_EXPIRES_IN') or 3600)
+    API_MAX_PER_PAGE = 100
+    # rows fetched from the database and written to an export response at a time
+    EXPORT_CHUNK_SIZE = 1000
+    TIMELINE_FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT') or 1000)
+    # equations copied per statement into a new follower's timeline, all of the author's equations are copied
+    TIMELINE_BACKFILL = 500
     LANGUAGES = ['en', 'es']
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    # 'elasticsearch', 'sqlite' (the embedded index at SEARCH_INDEX_PATH) or 'none', defaults to elasticsearch
+    # when ELASTICSEARCH_URL is set and sqlite otherwise
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND')
+    SEARCH_INDEX_PATH = os.environ.get('SEARCH_INDEX_PATH') or os.path.join(basedir, 'search.db')
+    # index changes are sent with the bulk API in batches bounded by size and by seconds waited
+    SEARCH_BATCH_SIZE = 500
+    SEARCH_BATCH_INTERVAL = 1.0
+    SEARCH_MAX_RETRIES = 5
+    SEARCH_QUEUE_SIZE = 100000
     POSTS_PER_PAGE = 10
+    # 'memory' (per process LRU), 'filesystem' (CACHE_DIR, shared by the workers of one host) or 'none'
+    CACHE_TYPE = os.environ.get('CACHE_TYPE') or 'memory'
+    CACHE_DIR = os.environ.get('CACHE_DIR') or os.path.join(basedir, 'cache')
+    CACHE_DEFAULT_TIMEOUT = int(os.environ.get('CACHE_DEFAULT_TIMEOUT') or 300)
+    # rows of recently active users kept by each process for the flask-login user loader, for at most
+    # USER_CACHE_TIMEOUT seconds after a write made by another process
+    USER_CACHE_SIZE = 10000
+    USER_CACHE_TIMEOUT = int(os.environ.get('USER_CACHE_TIMEOUT') or 30)
+    # feed pages plus one entry per rendered equation row
+    CACHE_THRESHOLD = int(os.environ.get('CACHE_THRESHOLD') or 10000)
+    # seconds between bulk last_seen writes, and how stale a stored last_seen may get before it is rewritten
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 60)
+    LAST_SEEN_TOLERANCE = int(os.environ.get('LAST_SEEN_TOLERANCE') or 60)
+    # seconds between keep-alive comments on idle notification streams, and the most streams a process will hold.
+    # every stream ties up a worker, with threaded workers keep the cap below the thread count (see NotificationHub)
+    NOTIFICATION_HEARTBEAT = 15
+    NOTIFICATION_MAX_LISTENERS = int(os.environ.get('NOTIFICATION_MAX_LISTENERS') or 1000)
@@ -1,14 +1,110 @@
+import base64
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import re
+import smtplib
+import tempfile
+import time
 import unittest
+from unittest import mock
 from datetime import datetime, timedelta
 
-from app import db, create_app
-from app.models import User, Equation
+import flask_mail
+from flask import template_rendered
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+from werkzeug.security import generate_password_hash
+
+from app import db, create_app, mail
+from app.cache import Cache, FileSystemCache, NullCache
+from app.email import MailPool, send_email
+from app.importer import import_equations, insert_rows
+from app.last_seen import LastSeenBuffer
+from app.passwords import PasswordHasher, PasswordHasherBusy
+from app.log import ErrorMailFilter, configure_logging, stop_logging
+from app.search import ElasticsearchBackend, SearchIndexer, index_action, remove_from_index
+from app.expressions import ExpressionError, compile_expression
+from app.models import User, Equation, Message, Notification, load_user, timeline
+from app.pagination import keyset_paginate
+from app.query_plans import check_query_plans
 from config import Config
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SEARCH_INDEX_PATH = ':memory:'
+    SEARCH_BATCH_INTERVAL = 0.05
+    MAIL_RETRY_DELAY = 0.01
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+
+
+class FakeElasticsearch(object):
+    # stands in for the bulk API, failing the first `failures` requests
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.requests = []
+
+    def bulk(self, body):
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError('elasticsearch is down')
+        self.requests.append(body)
+        return {'errors': False, 'items': []}
+
+
+class FakeMail(object):
+    # stands in for an SMTP server that drops the connection on the first `failures` messages
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.connections = 0
+        self.outbox = []
+
+    def connect(self):
+        return FakeMailConnection(self)
+
+
+class FakeMailConnection(object):
+    def __init__(self, mail):
+        self.mail = mail
+
+    def __enter__(self):
+        self.mail.connections += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+    def send(self, message):
+        if self.mail.failures > 0:
+            self.mail.failures -= 1
+            raise smtplib.SMTPServerDisconnected('connection unexpectedly closed')
+        self.mail.outbox.append(message)
+
+
+class QueryCounter(object):
+    # counts the statements sent to the database while active
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        event.remove(self.engine, 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        return len(self.statements)
 
 
 class UserModelCase(unittest.TestCase):
@@ -53,16 +149,107 @@ class UserModelCase(unittest.TestCase):
         for test in equation_answers:
             self.assertEqual(test[0], test[1])
 
+    def test_evaluate_batch(self):
+        u = User(username='karl')
+        db.session.add(u)
+        db.session.commit()
+        rows, errors = Equation.evaluate_batch([[10, '+', 2], [10, '/', 0], [10, '/', 4], ['ten', '*', 2],
+                                                [10, '%', 2], [3, '*', '2.5']])
+        self.assertEqual([row['equation_result'] if row else None for row in rows], [12, None, 2.5, None, None, 7.5])
+        self.assertEqual(sorted(errors), [1, 3, 4])
+        self.assertEqual(rows[2]['equation_str'], '10.00 / 4.00 = 2.50')
+        self.assertEqual(Equation.insert_batch(u, rows), 3)
+        db.session.commit()
+        self.assertEqual(u.equations.count(), 3)
+
+    def test_expression(self):
+        u = User(username='karl')
+        e = Equation(x_var=16, y_var=3, expression='sqrt(x)  +  y ** 2', author=u)
+        e.calculate()
+        self.assertEqual(e.equation_result, 13)
+        self.assertEqual(e.equation_str, 'sqrt(x) + y ** 2 = 13.00 (x = 16.00, y = 3.00)')
+        self.assertIs(compile_expression('sqrt(x) + y ** 2'), compile_expression(' sqrt(x) + y ** 2 '))
+        for source in ['__import__("os")', 'x.real', '(lambda: 1)()', 'open("f")', 'x +', '"a" * 3']:
+            self.assertRaises(ExpressionError, compile_expression, source)
+        self.assertRaises(ExpressionError, compile_expression('log(x)').evaluate, -1)
+        self.assertRaises(ExpressionError, compile_expression('9 ** 9 ** 9').evaluate)
+        rows, errors = Equation.evaluate_batch([[4, 'sqrt(x) * y', 3], [-4, 'sqrt(x)', 0], [4, '+', 1]])
+        self.assertEqual([row and row['equation_result'] for row in rows], [6, None, 5])
+        self.assertEqual(list(errors), [1])
+
+        # a division by zero reads the same through calculate() and evaluate_batch
+        e = Equation(x_var=1, y_var=0, expression='x / y', author=u)
+        with self.assertRaises(ExpressionError) as raised:
+            e.calculate()
+        rows, errors = Equation.evaluate_batch([[1, 'x / y', 0], [1, '/', 0]])
+        self.assertEqual(list(errors.values()), [str(raised.exception)] * 2)
+
+    def test_keyset_paginate(self):
+        u = User(username='karl')
+        now = datetime.utcnow()
+        # pairs of equations share a timestamp so the id has to break the tie
+        equations = [Equation(x_var=i, y_var=1, operator='+', author=u, timestamp=now + timedelta(seconds=i // 2))
+                     for i in range(7)]
+        for e in equations:
+            e.calculate()
+        db.session.add_all(equations)
+        db.session.commit()
+        newest_first = equations[::-1]
+
+        page1 = keyset_paginate(Equation.query, 3)
+        self.assertEqual(page1.items, newest_first[:3])
+        self.assertFalse(page1.has_prev)
+        page2 = keyset_paginate(Equation.query, 3, after=page1.next_cursor)
+        self.assertEqual(page2.items, newest_first[3:6])
+        page3 = keyset_paginate(Equation.query, 3, after=page2.next_cursor)
+        self.assertEqual(page3.items, newest_first[6:])
+        self.assertFalse(page3.has_next)
+        back = keyset_paginate(Equation.query, 3, before=page3.prev_cursor)
+        self.assertEqual(back.items, page2.items)
+        back = keyset_paginate(Equation.query, 3, before=back.prev_cursor)
+        self.assertEqual(back.items, page1.items)
+        self.assertFalse(back.has_prev)
+        self.assertEqual(keyset_paginate(u.equations, 3, after='not a cursor').items, page1.items)
+
     def test_password_hashing(self):
         u = User(username='frank')
         u.set_password('karl')
         self.assertFalse(u.check_password('frank'))
         self.assertTrue(u.check_password('karl'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+
+        # hashes made under an older policy are upgraded on a successful check
+        u.password_hash = generate_password_hash('karl', method='pbkdf2:sha256:500')
+        self.assertFalse(u.check_password('frank'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:500$'))
+        self.assertTrue(u.check_password('karl'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertTrue(u.check_password('karl'))
+        stats = self.app.password_hasher.stats()
+        self.assertEqual((stats['hash']['count'], stats['verify']['count']), (2, 5))
+        self.assertGreater(stats['verify']['max_seconds'], 0)
+
+        # a method without an iteration count matches the hashes werkzeug makes for it
+        hasher = PasswordHasher('pbkdf2:sha256')
+        self.assertFalse(hasher.needs_rehash(hasher.hash('karl')))
+        self.assertTrue(hasher.needs_rehash(u.password_hash))
+
+        hasher = PasswordHasher('pbkdf2:sha256:1000', workers=1, queue_size=0, timeout=0.01)
+        hasher.slots.acquire()
+        self.assertRaises(PasswordHasherBusy, hasher.hash, 'karl')
+        self.assertEqual(hasher.stats()['hash_rejected']['count'], 1)
 
     def test_avatar(self):
         u = User(username='pete', email='pete@nonexistantemail.com')
         self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/a631cb11854bd6ed0fc90cafea4e3d31'
                                          '?d=identicon&s=128'))
+        self.assertEqual(u.avatar_hash, 'a631cb11854bd6ed0fc90cafea4e3d31')
+        u.email = 'Susan@example.com'
+        self.assertEqual(u.avatar_hash, User.email_digest('susan@example.com'))
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u, u2])
+        db.session.commit()
+        self.assertEqual(User.avatar_urls([u, u2, u], 70), {u.id: u.avatar(70), u2.id: u2.avatar(70)})
 
     def test_follow(self):
         u1 = User(username='john', email='john@nonexistantemail.com')
@@ -129,6 +316,633 @@ class UserModelCase(unittest.TestCase):
         self.assertCountEqual(f3, [e3, e4])
         self.assertCountEqual(f4, [e4])
 
+    def test_timeline_fanout(self):
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        e1 = Equation(x_var=1, y_var=1, operator='+', author=u2)
+        e1.calculate()
+        db.session.add(e1)
+        db.session.commit()
+        u1.follow(u2)  # backfills e1
+        u1.follow(u3)
+        u2.follow(u3)
+        db.session.commit()
+
+        # mary now has more followers than the limit, so her equations are read from the equation table
+        e2 = Equation(x_var=2, y_var=2, operator='*', author=u3)
+        e2.calculate()
+        db.session.add(e2)
+        db.session.commit()
+        self.assertTrue(u3.fanout_on_read)
+        self.assertEqual(db.session.query(timeline).filter_by(equation_id=e2.id).count(), 1)
+        self.assertEqual(keyset_paginate(u1.followed_equation_sources(), 10).items, [e2, e1])
+        self.assertCountEqual(u2.followed_equations().all(), [e1, e2])
+
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_equations().all(), [e2])
+
+        # following copies the author's whole history, a batch at a time
+        self.app.config['TIMELINE_BACKFILL'] = 2
+        Equation.insert_batch(u2, Equation.evaluate_batch([[i, '+', 1] for i in range(4)])[0])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(db.session.query(timeline).filter_by(user_id=u1.id).count(), 5)
+        self.assertEqual(keyset_paginate(u1.followed_equation_sources(), 10).items,
+                         keyset_paginate(u2.equations.union(u3.equations), 10).items)
+
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        u1.follow(u3)
+        u3.follow(u2)
+        e = Equation(x_var=1, y_var=1, operator='+', author=u2)
+        e.calculate()
+        db.session.add(e)
+        db.session.commit()
+        Equation.insert_batch(u2, Equation.evaluate_batch([[1, '+', 2], [3, '*', 4]])[0])
+        u1.unfollow(u3)
+        db.session.commit()
+        counters = [(u.followers_count, u.following_count, u.equations_count) for u in (u1, u2, u3)]
+        self.assertEqual(counters, [(0, 1, 0), (2, 0, 3), (0, 1, 0)])
+        db.session.add_all([Message(author=u1, recipient=u2, body='hi'), Message(author=u3, recipient=u2, body='yo')])
+        db.session.commit()
+        self.assertEqual(u2.new_messages(), 2)
+
+        db.session.execute(User.__table__.update().values(followers_count=7, following_count=7, equations_count=7,
+                                                           unread_message_count=7))
+        User.reconcile_counters()
+        db.session.commit()
+        self.assertEqual([(u.followers_count, u.following_count, u.equations_count) for u in (u1, u2, u3)],
+                         counters)
+        self.assertEqual(u2.new_messages(), 2)
+
+    def test_last_seen_buffer(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com', last_seen=datetime.utcnow())
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        buffer = LastSeenBuffer(flush_interval=0, tolerance=60)
+        now = datetime.utcnow() + timedelta(minutes=5)
+        self.assertTrue(buffer.touch(u1.id, datetime(2000, 1, 1), now=now))
+        self.assertFalse(buffer.touch(u1.id, datetime(2000, 1, 1), now=now + timedelta(seconds=1)))
+        self.assertFalse(buffer.touch(u2.id, u2.last_seen))
+        self.assertTrue(buffer.flush_due())
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(u1.last_seen, now)
+        self.assertFalse(buffer.flush_due())
+
+        # with an app the buffer is flushed in the background, without waiting for another request
+        buffer = LastSeenBuffer(flush_interval=0.05, tolerance=60, app=self.app)
+        self.assertTrue(buffer.touch(u2.id, datetime(2000, 1, 1), now=now))
+        for _ in range(100):
+            db.session.rollback()
+            if u2.last_seen == now:
+                break
+            time.sleep(0.01)
+        self.assertEqual(u2.last_seen, now)
+
+    def test_notification_stream(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        listener = self.app.notification_hub.subscribe(u.id)
+        u.add_notification('unread_message_count', 1)
+        db.session.rollback()
+        for count in range(2, 6):
+            u.add_notification('unread_message_count', count)
+        self.assertTrue(listener.empty())
+        db.session.commit()
+        # the burst is coalesced into a single row and a single event
+        self.assertEqual(listener.get_nowait()['data'], 5)
+        self.assertTrue(listener.empty())
+        self.assertEqual([n.get_data() for n in u.notifications], [5])
+        u.add_notification('unread_message_count', 2)
+        db.session.commit()
+        self.assertEqual([n.get_data() for n in u.notifications], [2])
+        self.app.notification_hub.unsubscribe(u.id, listener)
+
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        response = client.get('/notifications/stream', buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = iter(response.response)
+        next(events)  # retry interval
+        self.assertIn('event: unread_message_count', next(events).decode())
+        u.add_notification('unread_message_count', 3)
+        db.session.commit()
+        self.assertIn('"data": 3', next(events).decode())
+        response.close()
+        self.assertEqual(self.app.notification_hub.listener_count, 0)
+
+        # a failing backlog query does not leave the listener subscribed
+        with mock.patch.object(Notification, 'to_dict', side_effect=RuntimeError):
+            self.assertRaises(RuntimeError, client.get, '/notifications/stream')
+        self.assertEqual(self.app.notification_hub.listener_count, 0)
+
+        # streams beyond the per-process cap are turned away
+        self.app.notification_hub.max_listeners = 0
+        response = client.get('/notifications/stream')
+        self.assertEqual((response.status_code, response.headers['Retry-After']), (503, '30'))
+
+    def test_search_indexing(self):
+        self.app.search_backend = ElasticsearchBackend(FakeElasticsearch(failures=1), self.app.logger)
+        u = User(username='john', email='john@example.com')
+        e = Equation(x_var=6, y_var=7, operator='*', author=u)
+        e.calculate()
+        db.session.add_all([u, e])
+        db.session.commit()
+        Equation.insert_batch(u, Equation.evaluate_batch([[1, '+', 2], [3, '*', 4]])[0])
+        db.session.rollback()
+        Equation.insert_batch(u, Equation.evaluate_batch([[1, '+', 1]])[0])
+        db.session.commit()
+        self.app.search_indexer.flush()
+        client = self.app.search_backend.client
+        sources = [line for body in client.requests for line in body if 'index' not in line]
+        self.assertEqual([source['equation_result'] for source in sources], [42, 2])
+
+        client.requests = []
+        self.assertEqual(Equation.reindex(chunk_size=1), 2)
+        self.assertEqual(len(client.requests), 2)
+
+        # a full queue drops actions without blocking the commit, stopping sends what is still queued
+        client.requests = []
+        self.app.config['SEARCH_QUEUE_SIZE'] = 2
+        indexer = SearchIndexer(self.app)
+        with mock.patch.object(indexer, 'start'):
+            started = time.monotonic()
+            indexer.enqueue([index_action('equation', e, Equation.__searchable__)] * 5)
+            self.assertLess(time.monotonic() - started, 0.5)
+        indexer.start()
+        indexer.stop()
+        self.assertFalse(indexer.thread.is_alive())
+        self.assertEqual(indexer.dropped, 3)
+        self.assertEqual(sum(len(body) for body in client.requests), 4)
+
+    def test_local_search(self):
+        u = User(username='john', email='john@example.com')
+        rows, errors = Equation.evaluate_batch([[1, '+', 2], [16, 'sqrt(x) + y', 2], [10, '*', 4], [3, '-', 1.5]])
+        db.session.add(u)
+        db.session.commit()
+        Equation.insert_batch(u, rows)
+        db.session.commit()
+        self.app.search_indexer.flush()
+        ids = {e.equation_result: e.id for e in Equation.query}
+
+        def search(query):
+            equations, total = Equation.search(query, 1, 10)
+            return sorted(e.equation_result for e in equations), total
+
+        self.assertEqual(search('6'), ([6], 1))
+        self.assertEqual(search('3'), ([1.5, 3], 2))  # 3 is an operand of one and the result of the other
+        self.assertEqual(search('equation_result:3'), ([3], 1))
+        self.assertEqual(search('equation_result:>=3 x_var:<16'), ([3, 40], 2))
+        self.assertEqual(search('y_var:1..2.5'), ([1.5, 3, 6], 3))
+        self.assertEqual(search('sqrt'), ([6], 1))
+        self.assertEqual(search('sqrt y_var:4'), ([], 0))
+        # a page past the last hit is empty but keeps the total
+        equations, total = Equation.search('3', 5, 10)
+        self.assertEqual((equations.all(), total), ([], 2))
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        self.assertEqual(client.get('/search?q=3&page=5').status_code, 200)
+        self.assertEqual(client.get('/search?q=3&page=-1').status_code, 200)
+        remove_from_index('equation', Equation.query.get(ids[6]))
+        self.assertEqual(search('sqrt'), ([], 0))
+
+    def test_mail_pool(self):
+        with mail.record_messages() as outbox:
+            for i in range(3):
+                send_email(f'message {i}', 'admin@example.com', ['john@example.com'], 'text', '<p>html</p>')
+            self.app.mail_pool.flush()
+        self.assertEqual(sorted(msg.subject for msg in outbox), ['message 0', 'message 1', 'message 2'])
+
+        self.app.config['MAIL_WORKERS'] = 1
+        fake = FakeMail(failures=1)
+        pool = MailPool(self.app, fake)
+        for i in range(5):
+            self.assertTrue(pool.submit(flask_mail.Message(f'message {i}', sender='admin@example.com',
+                                                           recipients=['john@example.com'])))
+        pool.flush()
+        self.assertEqual([msg.subject for msg in fake.outbox], [f'message {i}' for i in range(5)])
+        # one reconnect after the dropped connection, then every message shares it
+        self.assertEqual(fake.connections, 2)
+        stats = pool.stats()
+        self.assertEqual((stats['queued'], stats['sent'], stats['retried'], stats.get('failed', 0)), (5, 5, 1, 0))
+
+    def test_logging_pipeline(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            self.app.config.update(LOG_FILE=os.path.join(log_dir, 'math_app.log'),
+                                   LOG_JSON=os.path.join(log_dir, 'math_app.json'))
+            configure_logging(self.app)
+            self.app.logger.info('hello %s', 'world')
+            try:
+                1 / 0
+            except ZeroDivisionError:
+                self.app.logger.exception('division failed')
+            stop_logging(self.app)
+            with open(self.app.config['LOG_FILE']) as f:
+                text = f.read()
+            with open(self.app.config['LOG_JSON']) as f:
+                entries = [json.loads(line) for line in f]
+        self.assertIn('INFO: hello world', text)
+        self.assertIn('ZeroDivisionError: division by zero', text)
+        self.assertEqual([entry['message'] for entry in entries], ['hello world', 'division failed'])
+        self.assertTrue(entries[1]['exception'].endswith('ZeroDivisionError: division by zero'))
+        self.assertEqual(self.app.logger.handlers, [])
+
+        now = [0]
+        mail_filter = ErrorMailFilter(limit=2, interval=60, dedup_window=10, clock=lambda: now[0])
+
+        def record(lineno, message='failed'):
+            return logging.LogRecord('app', logging.ERROR, 'app.py', lineno, message, None, None)
+
+        self.assertTrue(mail_filter.filter(record(1)))
+        self.assertFalse(mail_filter.filter(record(1)))
+        r = record(2)
+        self.assertTrue(mail_filter.filter(r))
+        self.assertEqual(r.suppressed_mails, 1)
+        # over the limit
+        self.assertFalse(mail_filter.filter(record(3)))
+        self.assertFalse(mail_filter.filter(record(4)))
+        now[0] = 61
+        r = record(1)
+        self.assertTrue(mail_filter.filter(r))
+        self.assertEqual(r.suppressed_mails, 2)
+
+    def test_feed_cache(self):
+        self.app.config['EQUATIONS_PER_PAGE'] = 2
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        Equation.insert_batch(u1, Equation.evaluate_batch([[1, '+', 1], [1, '+', 2], [1, '+', 3]])[0])
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u2.id)
+        renders = []
+
+        def record(sender, template, context, **extra):
+            if template.name == '_equations.html':
+                renders.append(template.name)
+
+        template_rendered.connect(record, self.app)
+        try:
+            first = client.get('/explore').get_data(as_text=True)
+            self.assertEqual(client.get('/explore').get_data(as_text=True), first)
+            self.assertEqual(len(renders), 1)
+            after = re.search(r'/explore\?after=([\w-]+)', first).group(1)
+            client.get('/explore', query_string={'after': after})
+            client.get('/user/john')
+            self.assertEqual(len(renders), 3)
+
+            # a new equation changes the first pages but not the older ones
+            Equation.insert_batch(u1, Equation.evaluate_batch([[2, '*', 21]])[0])
+            db.session.commit()
+            self.assertIn('2.00 * 21.00 = 42.00', client.get('/explore').get_data(as_text=True))
+            client.get('/explore', query_string={'after': after})
+            client.get('/user/john')
+            self.assertEqual(len(renders), 5)
+
+            # renaming the author invalidates every page showing their equations
+            u1.username = 'johnny'
+            db.session.commit()
+            client.get('/explore', query_string={'after': after})
+            self.assertIn('johnny', client.get('/user/johnny').get_data(as_text=True))
+            self.assertEqual(len(renders), 7)
+
+            # a commit landing between the query and the cache write leaves no stale page behind
+            def paginate_then_invalidate(*args, **kwargs):
+                page = keyset_paginate(*args, **kwargs)
+                self.app.cache.invalidate('explore')
+                return page
+
+            self.app.cache.invalidate('explore')
+            with mock.patch('app.main.routes.keyset_paginate', paginate_then_invalidate):
+                client.get('/explore')
+            self.assertEqual(len(renders), 8)
+            client.get('/explore')
+            self.assertEqual(len(renders), 9)
+            client.get('/explore')
+            self.assertEqual(len(renders), 9)
+        finally:
+            template_rendered.disconnect(record, self.app)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = Cache(FileSystemCache(cache_dir, threshold=10))
+            cache.set('page', 'html', cache.versions(['explore']))
+            self.assertEqual(Cache(FileSystemCache(cache_dir)).get('page'), 'html')
+            cache.invalidate('explore')
+            self.assertIsNone(cache.get('page'))
+
+    def test_equation_fragment_cache(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u2.follow(u1)
+        Equation.insert_batch(u1, Equation.evaluate_batch([[1, '+', 1], [1, '+', 2]])[0])
+        Equation.insert_batch(u2, Equation.evaluate_batch([[2, '+', 2]])[0])
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u2.id)
+        renders = []
+
+        def record(sender, template, context, **extra):
+            if template.name == '_equation.html':
+                renders.append(context['equation'].id)
+
+        template_rendered.connect(record, self.app)
+        try:
+            first = client.get('/index').get_data(as_text=True)
+            self.assertEqual(len(renders), 3)
+            self.assertEqual(client.get('/index').get_data(as_text=True), first)
+            self.assertEqual(len(renders), 3)
+
+            # only the new row is rendered
+            Equation.insert_batch(u1, Equation.evaluate_batch([[3, '+', 3]])[0])
+            db.session.commit()
+            client.get('/index')
+            self.assertEqual(len(renders), 4)
+
+            # and only the renamed author's rows are rendered again
+            u1.username = 'johnny'
+            db.session.commit()
+            self.assertIn('johnny', client.get('/index').get_data(as_text=True))
+            self.assertEqual(len(renders), 7)
+        finally:
+            template_rendered.disconnect(record, self.app)
+
+    def test_list_view_query_counts(self):
+        # the number of queries a list view runs must not grow with the number of rows it shows
+        self.app.cache = Cache(NullCache())
+        reader = User(username='reader', email='reader@example.com')
+        authors = [User(username=f'author{i}', email=f'author{i}@example.com') for i in range(6)]
+        db.session.add_all([reader] + authors)
+        db.session.commit()
+        for author in authors:
+            reader.follow(author)
+            Equation.insert_batch(author, Equation.evaluate_batch([[author.id, '+', 1]])[0])
+            db.session.add(Message(author=author, recipient=reader, body=f'hi from {author.username}'))
+        db.session.commit()
+        self.app.search_indexer.flush()
+        reader_id = reader.id
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(reader_id)
+
+        pages = {}
+
+        def count_queries(path):
+            # a fresh session per request, as outside of tests, so the identity map hides nothing
+            db.session.remove()
+            with QueryCounter(db.engine) as counter:
+                response = client.get(path)
+            self.assertEqual(response.status_code, 200)
+            pages[path] = response.get_data(as_text=True)
+            return counter.count
+
+        paths = ['/index', '/explore', '/user/author0', '/messages', '/search?q=x_var:0..100']
+        # the first request fills the user loader cache
+        count_queries('/index')
+        counts = {}
+        for per_page in (2, 6):
+            self.app.config.update(EQUATIONS_PER_PAGE=per_page, POSTS_PER_PAGE=per_page)
+            counts[per_page] = {path: count_queries(path) for path in paths}
+            self.assertEqual(len(re.findall(r' \+ 1\.00 = ', pages['/search?q=x_var:0..100'])), per_page)
+        self.assertEqual(counts[2], counts[6])
+        self.assertIn('hi from author5', client.get('/messages').get_data(as_text=True))
+
+    def test_user_loader_cache(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        id = str(u.id)
+        db.session.remove()
+        with QueryCounter(db.engine) as counter:
+            self.assertEqual(load_user(id).username, 'john')
+            db.session.remove()
+            user = load_user(id)
+            self.assertEqual((user.username, user.email, user.avatar_hash), ('john', 'john@example.com',
+                                                                             User.email_digest('john@example.com')))
+        self.assertEqual(counter.count, 1)
+        self.assertIn(user, db.session)
+
+        # writes to the row drop the cached copy once they commit
+        user.username = 'johnny'
+        db.session.rollback()
+        self.assertIsNotNone(self.app.user_cache.get(f'user:{id}'))
+        user.username = 'johnny'
+        db.session.commit()
+        db.session.remove()
+        self.assertEqual(load_user(id).username, 'johnny')
+        buffer = LastSeenBuffer(flush_interval=0, tolerance=0)
+        buffer.touch(int(id), now=datetime(2021, 1, 1))
+        buffer.flush()
+        db.session.remove()
+        self.assertEqual(load_user(id).last_seen, datetime(2021, 1, 1))
+
+    def test_query_plans(self):
+        plans = check_query_plans()
+        self.assertEqual({name: [detail for detail, full_scan in plan if full_scan] for name, plan in plans.items()},
+                         {name: [] for name in plans})
+        self.assertIn('ix_followers_follower_id_followed_id', plans['is_following'][0][0])
+        self.assertIn('ix_message_recipient_id_timestamp', plans['messages'][0][0])
+        self.assertEqual(User.query.count(), 0)
+
+        with mock.patch('app.query_plans.explain', side_effect=RuntimeError('not supported on postgresql')):
+            result = self.app.test_cli_runner().invoke(args=['explain'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('Error: not supported on postgresql', result.output)
+
+    def test_sqlite_profile(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            class FileConfig(TestConfig):
+                SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(data_dir, 'app.db')
+
+            app = create_app(FileConfig)
+            with app.app_context():
+                self.assertIsInstance(db.engine.pool, QueuePool)
+                with db.engine.connect() as connection:
+                    pragmas = {pragma: connection.exec_driver_sql(f'PRAGMA {pragma}').scalar()
+                               for pragma in ('journal_mode', 'synchronous', 'busy_timeout', 'cache_size')}
+                db.engine.dispose()
+        # synchronous NORMAL is 1
+        self.assertEqual(pragmas, {'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': 5000,
+                                   'cache_size': -64000})
+
+    def test_api(self):
+        u1 = User(username='john', email='john@example.com')
+        u1.set_password('cat')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        client = self.app.test_client()
+
+        self.assertEqual(client.get('/api/v1/equations').status_code, 401)
+        self.assertEqual(client.post('/api/v1/tokens', headers={
+            'Authorization': 'Basic ' + base64.b64encode(b'john:dog').decode()}).status_code, 401)
+        response = client.post('/api/v1/tokens', headers={
+            'Authorization': 'Basic ' + base64.b64encode(b'john:cat').decode()})
+        self.assertEqual(response.status_code, 201)
+        headers = {'Authorization': 'Bearer ' + response.get_json()['token']}
+
+        response = client.post('/api/v1/equations', json={'equations': [[1, '+', 2], [1, '/', 0], [3, '*', 4]]},
+                               headers=headers)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.get_json()['created'], 2)
+        self.assertIn('error', response.get_json()['results'][1])
+        self.assertEqual(client.post('/api/v1/equations', json={'equations': 'x'}, headers=headers).status_code,
+                         400)
+
+        response = client.get('/api/v1/users/john/equations?limit=1', headers=headers)
+        page = response.get_json()
+        self.assertEqual([item['equation_result'] for item in page['items']], [12.0])
+        self.assertEqual(page['items'][0]['author'], 'john')
+        response = client.get(page['_links']['next'], headers=headers)
+        self.assertEqual([item['equation_result'] for item in response.get_json()['items']], [3.0])
+        self.assertEqual(client.get('/api/v1/users/nobody/equations', headers=headers).status_code, 404)
+        item = client.get(page['items'][0]['_links']['self'], headers=headers)
+        self.assertEqual(item.get_json()['equation_str'], page['items'][0]['equation_str'])
+
+        # an unchanged page is answered with 304 and no body
+        response = client.get('/api/v1/equations', headers=headers)
+        self.assertEqual(len(response.get_json()['items']), 2)
+        response = client.get('/api/v1/equations', headers=dict(headers, **{'If-None-Match': response.headers['ETag']}))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        u1.follow(u2)
+        db.session.commit()
+        Equation.insert_batch(u2, Equation.evaluate_batch([[5, '-', 1]])[0])
+        db.session.commit()
+        feed = client.get('/api/v1/feed', headers=headers).get_json()
+        self.assertEqual([item['author'] for item in feed['items']], ['susan', 'john', 'john'])
+
+        self.assertEqual(client.delete('/api/v1/tokens', headers=headers).status_code, 204)
+        self.assertEqual(client.get('/api/v1/feed', headers=headers).status_code, 401)
+
+    def test_export(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com', fanout_on_read=True)
+        db.session.add_all([u1, u2, u3])
+        u1.follow(u2)
+        u1.follow(u3)
+        db.session.commit()
+        Equation.insert_batch(u1, Equation.evaluate_batch([[1, '+', 1], [2, 'x * y', 3]])[0])
+        Equation.insert_batch(u2, Equation.evaluate_batch([[5, '-', 1]])[0])
+        Equation.insert_batch(u3, Equation.evaluate_batch([[6, '/', 2]])[0])
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u1.id)
+
+        response = client.get('/export')
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertIn('john-equations.csv', response.headers['Content-Disposition'])
+        rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual([(row['author'], row['equation_result']) for row in rows], [('john', '6.0'), ('john', '2.0')])
+        self.assertEqual(rows[0]['expression'], 'x * y')
+
+        # the feed is the home timeline, merged from the fanned out rows and the users fanned out on read
+        response = client.get('/export?format=ndjson&feed=1&gzip=1')
+        self.assertEqual(response.mimetype, 'application/gzip')
+        rows = [json.loads(line) for line in gzip.decompress(response.data).decode().splitlines()]
+        self.assertEqual(sorted(row['author'] for row in rows), ['john', 'john', 'mary', 'susan'])
+        self.assertEqual(client.get('/export?format=xml').status_code, 400)
+
+        result = self.app.test_cli_runner().invoke(args=['export-equations', 'john', '--format', 'ndjson',
+                                                         '--chunk-size', '1'])
+        self.assertEqual([json.loads(line)['equation_result'] for line in result.output.splitlines()], [6.0, 2.0])
+
+    def test_import(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        u2.follow(u1)
+        db.session.commit()
+        runner = self.app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as data_dir:
+            path = os.path.join(data_dir, 'equations.csv')
+            with open(path, 'w') as f:
+                f.write('username,x_var,operator,expression,y_var,timestamp\n'
+                        'john,1,+,,2,2020-01-01T00:00:00Z\n'
+                        'john,3,,x * y,4,\n'
+                        'nobody,1,+,,1,\n'
+                        'susan,1,/,,0,\n'
+                        'susan,five,+,,1,\n'
+                        'susan,5,-,,1,2020-02-30\n'
+                        'susan,10,*,,10,\n')
+            result = runner.invoke(args=['import-equations', path, '--chunk-size', '3'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn('Imported 3 equations, rejected 4 rows.', result.output)
+            self.assertIn("row 3: Unknown user 'nobody'.", result.output)
+            self.assertIn('row 6: Timestamps must be in ISO 8601 format.', result.output)
+
+            # an export imports again
+            export = runner.invoke(args=['export-equations', 'susan', '--format', 'ndjson', '--gzip',
+                                         '--output', os.path.join(data_dir, 'susan.ndjson.gz')])
+            self.assertEqual(export.exit_code, 0, export.output)
+            result = runner.invoke(args=['import-equations', os.path.join(data_dir, 'susan.ndjson.gz')])
+            self.assertIn('Imported 1 equations, rejected 0 rows.', result.output)
+
+        u1, u2 = User.query.filter_by(username='john').one(), User.query.filter_by(username='susan').one()
+        self.assertEqual(sorted(e.equation_result for e in u1.equations), [3, 12])
+        self.assertEqual(u1.equations.filter_by(equation_result=3).one().timestamp, datetime(2020, 1, 1))
+        self.assertEqual((u1.equations_count, u2.equations_count), (2, 2))
+        # fanned out to the follower's timeline, and indexed once at the end
+        self.assertEqual(sorted(e.equation_result for e in u2.followed_equations()), [3, 12, 100, 100])
+        self.app.search_indexer.flush()
+        self.assertEqual(Equation.search('x_var:10', 1, 10)[1], 2)
+
+        # an equation the web app commits for the same author while a chunk is imported is fanned out once
+        def insert_after_commit(rows):
+            Equation.insert_batch(u1, Equation.evaluate_batch([[5, '+', 5]])[0])
+            db.session.commit()
+            return insert_rows(rows)
+
+        with mock.patch('app.importer.insert_rows', insert_after_commit):
+            import_equations([{'username': 'john', 'x_var': 6, 'operator': '+', 'y_var': 6}])
+        self.assertEqual(sorted(e.equation_result for e in u2.followed_equations()), [3, 10, 12, 12, 100, 100])
+
+        # chunks committed before a failing one are indexed already
+        evaluated = Equation.evaluate_batch([[77, '+', 1]])
+        with mock.patch.object(Equation, 'evaluate_batch', side_effect=[evaluated, RuntimeError]):
+            self.assertRaises(RuntimeError, import_equations,
+                              [{'username': 'john', 'x_var': 77, 'operator': '+', 'y_var': 1}] * 2, 1)
+        self.app.search_indexer.flush()
+        self.assertEqual(Equation.search('x_var:77', 1, 10)[1], 1)
+        self.assertEqual(User.query.filter_by(username='john').one().equations_count, 5)
+
+        # a search outage leaves the equations unindexed but does not stop the import
+        self.app.search_indexer.max_retries = 0
+        with tempfile.TemporaryDirectory() as data_dir:
+            path = os.path.join(data_dir, 'equations.ndjson')
+            with open(path, 'w') as f:
+                f.write('{"username": "john", "x_var": 88, "operator": "+", "y_var": 1}\n' * 3)
+            with mock.patch.object(self.app.search_backend, 'bulk', side_effect=ConnectionError) as bulk:
+                result = runner.invoke(args=['import-equations', path, '--chunk-size', '1'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Imported 3 equations, rejected 0 rows.', result.output)
+        self.assertIn("3 rows not indexed for search, run 'flask reindex'", result.output)
+        # the backend is given up on after the first chunk
+        self.assertEqual(bulk.call_count, 1)
+        self.assertEqual(Equation.query.filter_by(x_var=88).count(), 3)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)